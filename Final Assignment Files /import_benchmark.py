@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures how long route_manager.py spends importing modules when it only writes CSV files and when it also draws a chart.
+Every mode runs in a fresh interpreter started with -X importtime, REPEAT times, and the median cumulative import time of every top
+level package is reported.
+Sample input: --REPEAT="5"
+"""
+
+# Importing all required modules
+import os
+import statistics
+import subprocess
+import sys
+
+
+# Code run by each mode after route_manager is imported: CSV-only runs stop there, chart runs import what create_bar needs
+MODES = {
+    'csv': 'import route_manager',
+    'chart': 'import route_manager; from matplotlib.figure import Figure; import pandas.plotting._matplotlib',
+}
+# Modules imported by the interpreter itself before any code runs
+STARTUP_MODULES = ('site', 'encodings', 'encodings.utf_8', 'io', 'abc', '_signal', 'zipimport', '_frozen_importlib_external',
+                   '_codecs', 'codecs', 'marshal', 'posix', 'time', 'winreg', 'nt', '_io', '_warnings', '_weakref')
+
+
+def get_arguments():
+    """Parameters
+        ----------
+            None
+            No parameters needed for this function.
+
+        Returns
+        -------
+            dict
+            The arguments obtained from the command line, keyed by argument name.
+    """
+    arguments = {}
+    for arg in range(1, len(sys.argv)):
+        argument = sys.argv[arg][2:]
+        split = argument.split("=", 1)
+        arguments[split[0]] = split[1] if len(split) > 1 else ""
+
+    return arguments
+
+
+def measure_imports(code):
+    """Parameters
+        ----------
+            code : str
+
+            Python code run in a fresh interpreter with -X importtime, from the directory of route_manager.py.
+
+        Returns
+        -------
+            dict
+            The cumulative import time in microseconds of every module imported by code. The modules route_manager
+            imports are listed one by one (its own code as route_manager), and the modules every interpreter imports at startup are left out.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+
+    packages = {}
+    children = []
+    for line in result.stderr.splitlines():
+        if (not line.startswith('import time:') or 'cumulative' in line):
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        # Every nested level is indented by two more spaces and printed before the module that imported it
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if (depth == 1):
+            children.append((name, int(cumulative)))
+        elif (depth == 0):
+            if (name == 'route_manager'):
+                for child, child_time in children:
+                    packages[child] = packages.get(child, 0) + child_time
+                packages[name] = int(own)
+            elif (name not in STARTUP_MODULES):
+                packages[name] = int(cumulative)
+            children = []
+
+    return packages
+
+
+def main():
+    """Main entry point of the program."""
+
+    arguments = get_arguments()
+    repeat = int(arguments.get('REPEAT', 5))
+
+    totals = {}
+    for mode, code in MODES.items():
+        runs = [measure_imports(code) for _ in range(repeat)]
+        packages = sorted({package for run in runs for package in run})
+        medians = {package: statistics.median(run.get(package, 0) for run in runs) for package in packages}
+        totals[mode] = statistics.median(sum(run.values()) for run in runs)
+
+        print(mode + ' (median of ' + str(repeat) + ' runs)')
+        for package in sorted(medians, key=medians.get, reverse=True)[:10]:
+            print('  ' + format(package, '<32') + format(medians[package] / 1000, '8.1f') + ' ms')
+        print('  ' + format('total', '<32') + format(totals[mode] / 1000, '8.1f') + ' ms')
+
+    print('CSV-only runs save ' + format((totals['chart'] - totals['csv']) / 1000, '.1f') + ' ms of imports per run')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of route_manager.py on synthetic airlines/airports/routes files.
+Generates files with a realistic skew (a few hub airports, airlines and countries get most of the routes) for every requested scale,
+times each phase of answering q1 to q5 and writes one JSON object per measurement, so runs of different versions can be compared.
+Sample input: --SCALES="10000,100000,1000000" --OUTPUT="bench.jsonl" --COMPARE="previous.jsonl"
+Other arguments: --DATA_DIR (where the generated files are kept and reused, default route_benchmark_data), --SEED, --LABEL (name of the
+run in the output, default the current git commit) and --GRAPH_TYPE (bar, pie or none to skip chart rendering).
+"""
+
+# Importing all required modules
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import route_manager
+
+
+# Countries given the most airports first, so Canada (used by q1 and q5) always has some
+COUNTRIES = ['United States', 'China', 'Canada', 'Brazil', 'Australia', 'Russia', 'India', 'Mexico', 'Germany', 'France', 'Japan',
+             'United Kingdom', 'Indonesia', 'Spain', 'Italy', 'Argentina', 'South Africa', 'Turkey', 'Chile', 'Kenya']
+
+
+def get_arguments():
+    """Parameters
+        ----------
+            None
+            No parameters needed for this function.
+
+        Returns
+        -------
+            dict
+            The arguments obtained from the command line, keyed by argument name.
+    """
+    arguments = {}
+    for arg in range(1, len(sys.argv)):
+        argument = sys.argv[arg][2:]
+        split = argument.split("=", 1)
+        arguments[split[0]] = split[1] if len(split) > 1 else ""
+
+    return arguments
+
+
+def zipf_weights(count, exponent):
+    """Parameters
+        ----------
+            count : int
+            exponent : float
+
+            count is the number of items and exponent how strongly the first items are favoured.
+
+        Returns
+        -------
+            numpy array
+            The probability of picking every item, proportional to 1 / rank ** exponent.
+    """
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    return weights / weights.sum()
+
+
+def icao_codes(count, rng):
+    """Parameters
+        ----------
+            count : int
+            rng : numpy Generator
+
+            count is the number of codes to make and rng the random generator used to shuffle them.
+
+        Returns
+        -------
+            numpy array
+            count distinct four letter codes.
+    """
+    numbers = rng.permutation(26 ** 4)[:count]
+    letters = [np.char.mod('%c', 65 + (numbers // 26 ** power) % 26) for power in range(4)]
+    return np.char.add(np.char.add(letters[3], letters[2]), np.char.add(letters[1], letters[0]))
+
+
+def write_yaml_list(file_name, key, columns):
+    """Parameters
+        ----------
+            file_name : str
+            key : str
+            columns : dict
+
+            Writes the records made of columns (one array of strings per field, all of the same length) to file_name as the list key, in
+            the same layout as the Kaggle files. Every value is quoted, so all of them are read back as strings.
+
+        Returns
+        -------
+            None
+            This function does not return anything.
+    """
+    names = list(columns)
+    rows = len(columns[names[0]])
+    with open(file_name, 'w') as f:
+        f.write(key + ':\n')
+        for start in range(0, rows, 100000):
+            lines = []
+            for row in range(start, min(start + 100000, rows)):
+                for number, name in enumerate(names):
+                    value = str(columns[name][row]).replace("'", "''")
+                    lines.append(('- ' if number == 0 else '  ') + name + ": '" + value + "'\n")
+            f.write(''.join(lines))
+
+
+def generate_dataset(data_dir, routes, seed):
+    """Parameters
+        ----------
+            data_dir : str
+            routes : int
+            seed : int
+
+            data_dir is the directory the files are written to, routes the number of routes and seed the seed of the random generator.
+            The number of airports and airlines grows with the number of routes. Route ends and airlines are drawn from Zipf distributions,
+            and a few percent of the routes point to airports or airlines missing from the other files, like in the real dataset.
+            Files that already exist for the same scale and seed are reused.
+
+        Returns
+        -------
+            dict
+            The AIRLINES, AIRPORTS and ROUTES file names, in the form route_manager expects its arguments.
+    """
+    prefix = os.path.join(data_dir, 'routes' + str(routes) + '_seed' + str(seed) + '_')
+    files = {'AIRLINES': prefix + 'airlines.yaml', 'AIRPORTS': prefix + 'airports.yaml', 'ROUTES': prefix + 'routes.yaml'}
+    if (all(os.path.exists(file_name) for file_name in files.values())):
+        return files
+
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    airport_count = min(max(routes // 8, 200), 20000)
+    airline_count = min(max(routes // 60, 20), 6000)
+
+    airport_ids = np.arange(1, airport_count + 1)
+    write_yaml_list(files['AIRPORTS'], 'airports', {
+        'airport_id': airport_ids,
+        'airport_name': np.char.add('Airport ', airport_ids.astype(str)),
+        'airport_city': np.char.add('City ', (airport_ids // 3).astype(str)),
+        'airport_country': np.array(COUNTRIES)[rng.choice(len(COUNTRIES), airport_count, p=zipf_weights(len(COUNTRIES), 0.8))],
+        'airport_icao_unique_code': icao_codes(airport_count, rng),
+        'airport_altitude': rng.gamma(1.2, 600, airport_count).astype(int),
+    })
+
+    airline_ids = np.arange(1, airline_count + 1)
+    write_yaml_list(files['AIRLINES'], 'airlines', {
+        'airline_id': airline_ids,
+        'airline_name': np.char.add('Airline ', airline_ids.astype(str)),
+        'airline_icao_unique_code': icao_codes(airline_count, rng),
+        'airline_country': np.array(COUNTRIES)[rng.integers(0, len(COUNTRIES), airline_count)],
+    })
+
+    # Shuffle the popularity ranks so the hubs are spread over every country
+    airport_ranks = rng.permutation(airport_ids)
+    airline_ranks = rng.permutation(airline_ids)
+    route_ends = airport_ranks[rng.choice(airport_count, (2, routes), p=zipf_weights(airport_count, 1.1))]
+    route_airlines = airline_ranks[rng.choice(airline_count, routes, p=zipf_weights(airline_count, 1.3))]
+    missing = rng.random((3, routes)) < 0.02
+    route_ends[0][missing[0]] += airport_count
+    route_ends[1][missing[1]] += airport_count
+    route_airlines[missing[2]] += airline_count
+    write_yaml_list(files['ROUTES'], 'routes', {
+        'route_airline_id': route_airlines,
+        'route_from_aiport_id': route_ends[0],
+        'route_to_airport_id': route_ends[1],
+    })
+
+    return files
+
+
+def timed(function, *parameters):
+    """Parameters
+        ----------
+            function : function
+            parameters : any
+
+            The function to time and the parameters it is called with.
+
+        Returns
+        -------
+            tuple
+            The value returned by function and the wall time it took in seconds.
+    """
+    start = time.perf_counter()
+    value = function(*parameters)
+    return value, time.perf_counter() - start
+
+
+def benchmark_scale(files, output_dir, graph_type):
+    """Parameters
+        ----------
+            files : dict
+            output_dir : str
+            graph_type : str
+
+            files are the input files of one scale, output_dir the directory the CSV and PDF files are written to and graph_type the chart
+            drawn for every question (none to skip charts).
+            The inputs are loaded with load_dataset and every question is answered with run_query, written with write_result and drawn
+            with draw_chart, the way route_manager answers them, while route_manager measures its phases (see measure_phase): the YAML
+            parse (load:<key>/parse) and the DataFrame build inside it (load:<key>/parse/dataframe_build), normalize, the labels, then for
+            every question the route index, merge, groupby, top_k (the sort), csv_write and chart:<graph_type>.
+
+        Returns
+        -------
+            list
+            One dict per phase with the question (None for the shared phases), phase, seconds and rows. Phases run several times, like
+            dataframe_build once per chunk, are summed.
+    """
+    arguments = dict(files, CACHE='no', LOAD_WORKERS='1', OUTPUT_DIR=output_dir, GRAPH_TYPE=graph_type)
+    phases = route_manager.start_instrumentation(trace_memory=False)
+
+    for key in ('airlines', 'airports', 'routes'):
+        route_manager.load_dataset(arguments, key)
+    route_manager.airport_labels(arguments)
+    route_manager.airline_labels(arguments)
+
+    for question, spec in route_manager.QUESTIONS.items():
+        with route_manager.measure_phase(question):
+            grouped_df = route_manager.run_query(arguments, spec)
+            route_manager.write_result(arguments, question, grouped_df)
+            if (graph_type != "none"):
+                route_manager.draw_chart(grouped_df, question, spec, graph_type, os.path.join(output_dir, question + '.pdf'))
+
+    route_manager.forget_datasets()
+
+    results = {}
+    for record in phases:
+        question, _, phase = record['phase'].partition('/')
+        if (question not in route_manager.QUESTIONS):
+            question, phase = None, record['phase']
+        elif (not phase):
+            continue
+        result = results.setdefault((question, phase), {'question': question, 'phase': phase, 'seconds': 0.0, 'rows': None})
+        result['seconds'] += record['wall_seconds']
+        if (record['rows'] is not None):
+            result['rows'] = (result['rows'] or 0) + record['rows']
+
+    return list(results.values())
+
+
+def run_label():
+    """Parameters
+        ----------
+            None
+            No parameters needed for this function.
+
+        Returns
+        -------
+            str
+            The short hash of the current git commit of this file, with +dirty when it has uncommitted changes, or an empty string outside
+            of a git checkout.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '.'], cwd=directory, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+    return commit + ('+dirty' if status.strip() else '')
+
+
+def print_comparison(results, previous_file):
+    """Parameters
+        ----------
+            results : list
+            previous_file : str
+
+            results are the measurements of this run and previous_file the JSON lines written by an earlier run.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does print the time of every phase in both runs and their ratio.
+    """
+    previous = {}
+    with open(previous_file, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            if ('phase' in record):
+                previous[(record['routes'], record['question'], record['phase'])] = record['seconds']
+
+    print(format('routes', '>10') + '  ' + format('question', '<10') + format('phase', '<44') + format('before', '>10') + format('after', '>10') + format('ratio', '>8'))
+    for record in results:
+        key = (record['routes'], record['question'], record['phase'])
+        if (key in previous):
+            ratio = record['seconds'] / previous[key] if previous[key] else float('inf')
+            print(format(record['routes'], '>10') + '  ' + format(record['question'] or '', '<10') + format(record['phase'], '<44')
+                  + format(previous[key], '10.4f') + format(record['seconds'], '10.4f') + format(ratio, '8.2f'))
+
+
+def main():
+    """Main entry point of the program."""
+
+    arguments = get_arguments()
+    scales = [int(scale) for scale in arguments.get('SCALES', '10000,100000').split(',')]
+    seed = int(arguments.get('SEED', 265))
+    data_dir = arguments.get('DATA_DIR', 'route_benchmark_data')
+    graph_type = arguments.get('GRAPH_TYPE', 'bar')
+
+    metadata = {
+        'label': arguments.get('LABEL', run_label()),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for routes in scales:
+            files, seconds = timed(generate_dataset, data_dir, routes, seed)
+            print('generated ' + str(routes) + ' routes in ' + format(seconds, '.1f') + ' s', file=sys.stderr)
+            for record in benchmark_scale(files, output_dir, graph_type):
+                record['routes'] = routes
+                results.append(record)
+
+    lines = [json.dumps(metadata)] + [json.dumps(dict(record, label=metadata['label'])) for record in results]
+    if ('OUTPUT' in arguments):
+        with open(arguments['OUTPUT'], 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    else:
+        print('\n'.join(lines))
+
+    if ('COMPARE' in arguments):
+        print_comparison(results, arguments['COMPARE'])
+
+
+if __name__ == '__main__':
+    main()
@@ -4,249 +4,2764 @@
 Created on Wed Feb 8 14:44:33 2023
 Based on: https://www.kaggle.com/datasets/arbazmohammad/world-airports-and-airlines-datasets
 Sample input: --AIRLINES="airlines.yaml" --AIRPORTS="airports.yaml" --ROUTES="routes.yaml" --QUESTION="q1" --GRAPH_TYPE="bar"
+--QUESTION="all" answers q1 to q5 in one run, parsing each input file only once.
+Parsed inputs are cached in --CACHE_DIR (default .route_cache), --REBUILD_CACHE="yes" forces a rebuild and --CACHE="no" disables it.
+Answers are cached in CACHE_DIR/results (at most --RESULT_CACHE_SIZE bytes), --CACHE_STATS="yes" prints its hits and misses.
+--TOP_N="25" changes the number of rows in every answer.
+--QUERY="group_by=airline;country=Mexico;limit=20" answers any QuerySpec instead of a question, several can be separated by |.
+--BATCH="manifest.yaml" answers every query listed in a manifest in one process (see run_batch).
+--GRAPH_TYPE is bar when it is not given, --GRAPH_TYPE="none" only writes the CSV files, matplotlib is then never imported.
+Charts of several answers are drawn in --RENDER_WORKERS worker processes (default: one per CPU).
+--SERVE="[host:]port" keeps the inputs in memory and answers GET /q1 (CSV) or GET /q1?graph=bar (PDF) requests until interrupted.
+--INSTRUMENT="table" prints the wall time, CPU time, peak memory and rows of every phase of the run to stderr, --INSTRUMENT="json"
+writes them as JSON lines to --INSTRUMENT_FILE (default stderr) and --TRACE_MEMORY="no" skips tracemalloc, which slows the run down.
+Charts drawn in worker processes are not measured, add --RENDER_WORKERS="1" to measure them too.
+--PROFILE="route_manager.pstats" runs the whole command under cProfile and writes its statistics to that file.
+--ROUTE_COUNTS="route_counts.pickle" keeps the route counts between runs and answers q1 to q4 from them, --ADD_ROUTES="added.yaml" and
+--REMOVE_ROUTES="removed.yaml" apply a delta of routes to the counts without reading ROUTES again (see load_route_counts).
+--OUT_OF_CORE="yes" streams the routes in chunks of --CHUNK_SIZE records (default 100000) instead of loading them, for routes files
+larger than memory. Nothing derived from every single route is kept, so every altitude question streams the routes again.
+--AGGREGATE_WORKERS="32" counts large routes tables in that many worker processes (default 1).
+--QUERY="group_by=airport;metric=degree;country=Canada", metric=betweenness, metric=stops;source=CYYZ;max_stops=1 and
+group_by=component;metric=airports answer questions about the route network (see run_graph_query).
+--SEARCH="toront" writes the airports and airlines whose name, city, ICAO code or country start like it or are close to it to
+search.csv, the search index is cached in CACHE_DIR.
+--OUTPUT_FORMAT="jsonl" writes the answers as JSON lines instead of CSV, parquet and arrow (Arrow IPC) need pyarrow.
+Answers and charts are written to --OUTPUT_DIR (default the current directory), --OUTPUT_FILE="results.jsonl" writes every answer of
+the run to that one file instead, with a question column (- writes them to stdout).
+AIRLINES, AIRPORTS and ROUTES may be compressed with gzip, xz or bzip2 (or zstd when zstandard is installed), they are decompressed
+while they are parsed. --DECOMPRESS_THREAD="yes" decompresses them in a background thread, so reading, decompression and parsing overlap.
+The input files a query reads are loaded at the same time, parsed in up to --LOAD_WORKERS worker processes (default: one per CPU).
+Only the fields the queries read are parsed. When a run answers a single query and parses its inputs (--CACHE="no" or
+--OUT_OF_CORE="yes"), the parser also drops the route ends and the records outside the country the query does not need (see load_filter).
 @author: rivera
 @author: sborissov
 """
 
 # Importing all required modules
 import sys
+import os
 import csv
+import bz2
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import lzma
+import queue
+import shutil
+import threading
+import contextlib
+import functools
+import time
+from typing import NamedTuple
 import numpy as np
 import pandas as pd
 import yaml
-import matplotlib.pyplot as plt
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then left out of the instrumentation
+    resource = None
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, concurrent runs may then lose some result cache statistics
+    fcntl = None
+
+
+# Use the LibYAML parser when PyYAML was built with it, it is many times faster than the pure Python one
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+STRING_TAG = 'tag:yaml.org,2002:str'
+# Bumped whenever the DataFrames stored in the input cache change shape or dtypes, so old entries are rebuilt
+CACHE_FORMAT_VERSION = 4
+# Fields of every dataset the queries read, the other fields of the records are skipped while they are parsed
+LOAD_COLUMNS = {
+    'airlines': ['airline_id', 'airline_name', 'airline_icao_unique_code'],
+    'airports': ['airport_id', 'airport_name', 'airport_city', 'airport_country', 'airport_icao_unique_code', 'airport_altitude'],
+    'routes': ['route_airline_id', 'route_from_aiport_id', 'route_to_airport_id'],
+}
+# Join keys converted to integers, text stripped of surrounding whitespace and repeated strings converted to categoricals when a dataset is loaded
+ID_COLUMNS = {
+    'airlines': ['airline_id'],
+    'airports': ['airport_id'],
+    'routes': ['route_airline_id', 'route_from_aiport_id', 'route_to_airport_id'],
+}
+TEXT_COLUMNS = {
+    'airlines': ['airline_name', 'airline_icao_unique_code'],
+    'airports': ['airport_name', 'airport_city', 'airport_country', 'airport_icao_unique_code'],
+    'routes': [],
+}
+CATEGORY_COLUMNS = {
+    'airlines': ['airline_name'],
+    'airports': ['airport_country', 'airport_city'],
+    'routes': [],
+}
+# Leading bytes of the compressed formats open_input recognizes
+COMPRESSION_MAGIC = {
+    b'\x1f\x8b': 'gzip',
+    b'\xfd7zXZ\x00': 'xz',
+    b'BZh': 'bz2',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+}
+# Bytes of decompressed input a DecompressionReader thread reads at a time, and the most blocks it gets ahead of the parser
+DECOMPRESS_BLOCK_SIZE = 1024 * 1024
+DECOMPRESS_QUEUE_BLOCKS = 8
+# Default number of bytes the result cache may hold before the least recently used results are evicted
+DEFAULT_RESULT_CACHE_SIZE = 64 * 1024 * 1024
+# Number of records gathered in column buffers before they are converted to a DataFrame chunk
+CHUNK_SIZE = 100000
+# Columns of every dataset whose values are found by search_names
+SEARCH_COLUMNS = {
+    'airports': ['airport_name', 'airport_city', 'airport_icao_unique_code', 'airport_country'],
+    'airlines': ['airline_name', 'airline_icao_unique_code'],
+}
+# File extension of every format answers can be written in, see write_table
+OUTPUT_FORMATS = {'csv': '.csv', 'jsonl': '.jsonl', 'parquet': '.parquet', 'arrow': '.arrow'}
+# Fewest routes counted by one worker process of count_routes_parallel, smaller tables are not worth starting processes for
+MIN_PARTITION_SIZE = 250000
+
+# DataFrames already parsed in this process, keyed by (file name, top level key)
+_loaded_frames = {}
+_loaded_fingerprints = {}
+# Route count tables and labelled entities derived from the loaded DataFrames, dropped whenever an input file changes
+_derived_frames = {}
+# Route counts of load_route_counts keyed by ROUTE_COUNTS file, they are not derived from an input file so they are kept when one changes
+_route_counts = {}
+_yaml_resolver = yaml.resolver.Resolver()
+_yaml_constructor = yaml.constructor.SafeConstructor()
+# Phases measured by measure_phase in the order they started, None unless --INSTRUMENT is given, and the phases still running
+_phases = None
+_phase_stack = []
+# Answers kept by write_result until write_output_file writes them to --OUTPUT_FILE
+_output_tables = []
+# The only query of the run, whose route ends and country load_filter pushes down into the YAML parser, None when the run answers several
+_pushed_query = None
 
 
 def get_arguments():
     """Parameters
         ----------
-            None
-            No parameters needed for this function.
+            None
+            No parameters needed for this function.
+
+        Returns
+        -------
+            None
+            This function does not return anything.
+    """
+    arguments = {}
+    for arg in range(1, len(sys.argv)):
+        argument = sys.argv[arg][2:]
+        split = argument.split("=", 1)
+        arguments[split[0]] = split[1] if len(split) > 1 else ""
+
+    if ('INSTRUMENT' in arguments):
+        start_instrumentation(arguments.get('TRACE_MEMORY', 'yes') != "no")
+
+    if ('PROFILE' in arguments):
+        # Imported here so that runs without PROFILE never pay for importing the profiler
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.runcall(run_arguments, arguments)
+        profile_file = arguments['PROFILE'] or 'route_manager.pstats'
+        profiler.dump_stats(profile_file)
+        print('Profile written to ' + profile_file + ', the slowest calls were:', file=sys.stderr)
+        pstats.Stats(profile_file, stream=sys.stderr).sort_stats('cumulative').print_stats(15)
+    else:
+        run_arguments(arguments)
+
+    if ('INSTRUMENT' in arguments):
+        report_phases(arguments)
+
+
+def run_arguments(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does answer the questions, queries or manifest given in arguments.
+    """
+    if (arguments.get('OUTPUT_FORMAT', 'csv') not in OUTPUT_FORMATS):
+        raise ValueError('Unknown output format ' + arguments['OUTPUT_FORMAT'] + ', expected one of ' + ', '.join(OUTPUT_FORMATS))
+    if (arguments.get('OUTPUT_FORMAT') in ('parquet', 'arrow') and not importlib.util.find_spec('pyarrow')):
+        raise ValueError('--OUTPUT_FORMAT="' + arguments['OUTPUT_FORMAT'] + '" needs pyarrow, which is not installed')
+    # Every answer is charted as a bar chart unless GRAPH_TYPE (or the graph_type of a manifest entry) says otherwise
+    arguments = dict(arguments, GRAPH_TYPE=arguments.get('GRAPH_TYPE', 'bar'))
+    if (arguments['GRAPH_TYPE'] not in ('bar', 'pie', 'none')):
+        raise ValueError('--GRAPH_TYPE must be bar, pie or none, not ' + arguments['GRAPH_TYPE'])
+
+    if ('ROUTE_COUNTS' in arguments):
+        load_route_counts(arguments)
+
+    if ('SERVE' in arguments):
+        serve(arguments)
+    elif ('BATCH' in arguments):
+        with ChartRenderer(int(arguments.get('RENDER_WORKERS', os.cpu_count()))) as renderer:
+            run_batch(arguments, renderer)
+    elif ('SEARCH' in arguments):
+        write_result(arguments, 'search', search_names(arguments, arguments['SEARCH'], int(arguments.get('TOP_N', 10))))
+    elif ('QUERY' in arguments):
+        specs = [limit_query(arguments, parse_query(text)) for text in arguments['QUERY'].split('|')]
+        if (len(specs) == 1):
+            push_down_query(specs[0])
+        with ChartRenderer(int(arguments.get('RENDER_WORKERS', os.cpu_count()))) as renderer:
+            for number, spec in enumerate(specs, 1):
+                answer_query(arguments, 'query' + str(number), spec, renderer)
+    elif (arguments['QUESTION'] == "all"):
+        with ChartRenderer(int(arguments.get('RENDER_WORKERS', os.cpu_count()))) as renderer:
+            for question, spec in QUESTIONS.items():
+                if ('ROUTE_COUNTS' in arguments and spec.metric == 'altitude_difference'):
+                    continue
+                answer_query(arguments, question, limit_query(arguments, spec), renderer)
+    else:
+        question = arguments['QUESTION'] if arguments['QUESTION'] in QUESTIONS else 'q5'
+        spec = limit_query(arguments, QUESTIONS[question])
+        push_down_query(spec)
+        answer_query(arguments, question, spec)
+
+    if ('OUTPUT_FILE' in arguments):
+        write_output_file(arguments)
+
+    if (arguments.get('CACHE_STATS', 'no') == "yes"):
+        print_result_stats(arguments)
+
+
+def answer_query(arguments, question, spec, renderer=None):
+    """Parameters
+        ----------
+            arguments : dict
+            question : str
+            spec : QuerySpec
+            renderer : ChartRenderer
+
+            arguments is the dictionary of command line arguments, question is the name of the output files (q1 to q5 for the predefined
+            questions) and spec is the query to answer. The chart is drawn by renderer when one is given, in which case it may still be
+            rendering when this function returns, otherwise it is drawn before returning.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does create the <question> file of the answer (see write_result) and
+            <question>.pdf in OUTPUT_DIR.
+    """
+    with measure_phase(question):
+        pdf = output_path(arguments, question, '.pdf')
+        if (arguments.get('CACHE', 'yes') == "no"):
+            grouped_df = run_query(arguments, spec)
+            write_result(arguments, question, grouped_df)
+            render_chart(renderer, grouped_df, question, spec, arguments['GRAPH_TYPE'], pdf)
+            return
+
+        results_dir = os.path.join(arguments.get('CACHE_DIR', '.route_cache'), 'results')
+        key = result_key(arguments, spec)
+        cached_csv = os.path.join(results_dir, key + '.csv')
+        # The table only depends on spec, but the chart of a predefined question has the labels of CHARTS instead of generated ones
+        chart = question + '.' if is_predefined_chart(question, spec) else ''
+        cached_pdf = os.path.join(results_dir, key + '.' + chart + arguments['GRAPH_TYPE'] + '.pdf')
+        charted = arguments['GRAPH_TYPE'] == "none" or os.path.exists(cached_pdf)
+
+        if (charted and os.path.exists(cached_csv)):
+            if (arguments.get('OUTPUT_FORMAT', 'csv') == "csv" and 'OUTPUT_FILE' not in arguments):
+                shutil.copyfile(cached_csv, output_path(arguments, question, '.csv'))
+            else:
+                write_result(arguments, question, pd.read_csv(cached_csv, keep_default_na=False))
+            os.utime(cached_csv)
+            if (arguments['GRAPH_TYPE'] != "none"):
+                shutil.copyfile(cached_pdf, pdf)
+                os.utime(cached_pdf)
+            update_result_stats(results_dir, hits=1)
+            return
+
+        if (os.path.exists(cached_csv)):
+            # Only the chart type changed, the table can be reused as it is
+            grouped_df = pd.read_csv(cached_csv, keep_default_na=False)
+            os.utime(cached_csv)
+        else:
+            grouped_df = run_query(arguments, spec)
+        write_result(arguments, question, grouped_df)
+
+        os.makedirs(results_dir, exist_ok=True)
+        if (not os.path.exists(cached_csv)):
+            # Write to a temporary name first so an interrupted run never leaves a truncated entry behind
+            temporary_file = cached_csv + '.' + str(os.getpid()) + '.tmp'
+            grouped_df.to_csv(temporary_file, index=False)
+            os.replace(temporary_file, cached_csv)
+        render_chart(renderer, grouped_df, question, spec, arguments['GRAPH_TYPE'], pdf, cached_pdf)
+        evictions = evict_results(results_dir, int(arguments.get('RESULT_CACHE_SIZE', DEFAULT_RESULT_CACHE_SIZE)))
+        update_result_stats(results_dir, misses=1, evictions=evictions)
+
+
+def output_path(arguments, question, extension):
+    """Parameters
+        ----------
+            arguments : dict
+            question : str
+            extension : str
+
+            arguments is the dictionary of command line arguments, question is the name of an answer and extension the extension of the file.
+
+        Returns
+        -------
+            str
+            The path of the file of question in OUTPUT_DIR (the current directory by default), which is created if needed.
+    """
+    output_dir = arguments.get('OUTPUT_DIR', '')
+    if (output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    return os.path.join(output_dir, question + extension)
+
+
+def write_result(arguments, question, grouped_df):
+    """Parameters
+        ----------
+            arguments : dict
+            question : str
+            grouped_df : pandas Dataframe
+
+            arguments is the dictionary of command line arguments, question is the name of the answer and grouped_df the answer.
+            OUTPUT_FORMAT chooses the format of the file (csv, jsonl, parquet or arrow, see OUTPUT_FORMATS). When OUTPUT_FILE is given the
+            answer is kept until write_output_file writes every answer of the run to that one file instead.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does create the <question> file of grouped_df in OUTPUT_DIR.
+    """
+    if ('OUTPUT_FILE' in arguments):
+        _output_tables.append((question, grouped_df))
+        return
+
+    output_format = arguments.get('OUTPUT_FORMAT', 'csv')
+    with measure_phase(output_format + '_write', len(grouped_df)):
+        write_table(grouped_df, output_path(arguments, question, OUTPUT_FORMATS[output_format]), output_format)
+
+
+def write_table(dataframe, target, output_format, header=True):
+    """Parameters
+        ----------
+            dataframe : pandas Dataframe
+            target : str or file
+            output_format : str
+            header : bool
+
+            dataframe is written to target, a file name or a file (a text file for csv and jsonl, a binary one otherwise), in output_format.
+            Parquet and Arrow IPC (Feather) files are written by pyarrow, the column types are kept so readers do not have to parse text.
+            header is False to leave out the CSV header, when dataframe is appended to rows already written.
+
+        Returns
+        -------
+            None
+            This function does not return anything.
+    """
+    if (output_format == "csv"):
+        dataframe.to_csv(target, index=False, header=header)
+    elif (output_format == "jsonl"):
+        dataframe.to_json(target, orient='records', lines=True, force_ascii=False)
+    elif (output_format == "parquet"):
+        dataframe.to_parquet(target, index=False)
+    else:
+        dataframe.to_feather(target)
+
+
+def write_output_file(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments: OUTPUT_FILE is the file every answer of the run is written to, - for stdout, in
+            OUTPUT_FORMAT.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does write every answer kept by write_result to one table, with the name of its
+            answer in a first question column. CSV and JSON lines answers are written one after the other, so every answer keeps the types
+            of its columns, while Parquet and Arrow files hold a single table whose statistic column is a float when answers mix route
+            counts and altitude differences.
+    """
+    output_format = arguments.get('OUTPUT_FORMAT', 'csv')
+    tables = [grouped_df.assign(question=question)[['question'] + list(grouped_df.columns)] for question, grouped_df in _output_tables]
+    _output_tables.clear()
+
+    with measure_phase(output_format + '_write', sum(len(table) for table in tables)):
+        text = output_format in ('csv', 'jsonl')
+        if (arguments['OUTPUT_FILE'] == "-"):
+            output = sys.stdout if text else sys.stdout.buffer
+        elif (text):
+            output = open(arguments['OUTPUT_FILE'], 'w', newline='')
+        else:
+            output = open(arguments['OUTPUT_FILE'], 'wb')
+        try:
+            if (text):
+                for number, table in enumerate(tables):
+                    write_table(table, output, output_format, header=number == 0)
+            else:
+                write_table(pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=['question']), output, output_format)
+        finally:
+            if (output not in (sys.stdout, sys.stdout.buffer)):
+                output.close()
+
+
+def run_batch(arguments, renderer=None):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments. BATCH is a YAML manifest with a queries list, where every entry has either a question
+            (q1 to q5) or a query (a QuerySpec as a mapping of fields or as "field=value;..." text), and optionally the name of its output
+            files and its graph_type. The manifest may also give the airlines, airports and routes files, replacing the command line ones:
+
+                routes: routes.yaml
+                queries:
+                  - question: q1
+                    graph_type: pie
+                  - name: mexico_airlines
+                    query: {group_by: airline, country: Mexico, limit: 20}
+
+            Every query runs in this process, so the input files are parsed and the route indexes and labels they share are built once.
+            The charts are drawn by renderer when one is given.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does create a <name>.csv and <name>.pdf file for every query of the manifest.
+    """
+    with open(arguments['BATCH'], 'r') as f:
+        manifest = yaml.safe_load(f)
+
+    arguments = dict(arguments)
+    for key in ('airlines', 'airports', 'routes'):
+        if (key in manifest):
+            arguments[key.upper()] = manifest[key]
+
+    # Check the whole manifest before answering anything, so a typo does not surface after minutes of work
+    jobs = []
+    for number, entry in enumerate(manifest['queries'], 1):
+        if ('question' in entry):
+            spec = QUESTIONS[entry['question']]
+            name = entry.get('name', entry['question'])
+        elif (isinstance(entry.get('query'), dict)):
+            spec = make_query({field: str(value) for field, value in entry['query'].items()})
+            name = entry.get('name', 'query' + str(number))
+        else:
+            spec = parse_query(entry['query'])
+            name = entry.get('name', 'query' + str(number))
+        graph_type = entry.get('graph_type', arguments['GRAPH_TYPE'])
+        if (graph_type not in ('bar', 'pie', 'none')):
+            raise ValueError('graph_type of ' + name + ' must be bar, pie or none, not ' + str(graph_type))
+        jobs.append((name, limit_query(arguments, spec), graph_type))
+
+    for name, spec, graph_type in jobs:
+        answer_query(dict(arguments, GRAPH_TYPE=graph_type), name, spec, renderer)
+
+
+def store_copy(file_name, copy_name):
+    """Parameters
+        ----------
+            file_name : str
+            copy_name : str
+
+            Copies file_name to copy_name through a temporary file, so that readers of copy_name never see a partial copy.
+
+        Returns
+        -------
+            None
+            This function does not return anything.
+    """
+    temporary_file = copy_name + '.' + str(os.getpid()) + '.tmp'
+    shutil.copyfile(file_name, temporary_file)
+    os.replace(temporary_file, copy_name)
+
+
+def render_chart(renderer, grouped_df, question, spec, graph_type, pdf, copy_name=None):
+    """Parameters
+        ----------
+            renderer : ChartRenderer
+            grouped_df : pandas Dataframe
+            question : str
+            spec : QuerySpec
+            graph_type : str
+            pdf : str
+            copy_name : str
+
+            Draws the chart of grouped_df with draw_chart, in renderer when it is not None, and then copies pdf to copy_name when it is given.
+            Nothing is drawn when graph_type is none.
+
+        Returns
+        -------
+            None
+            This function does not return anything.
+    """
+    if (graph_type == "none"):
+        return
+    if (renderer is None):
+        draw_chart(grouped_df, question, spec, graph_type, pdf, copy_name)
+    else:
+        renderer.submit(grouped_df, question, spec, graph_type, pdf, copy_name)
+
+
+def result_key(arguments, spec):
+    """Parameters
+        ----------
+            arguments : dict
+            spec : QuerySpec
+
+            arguments is the dictionary of command line arguments and spec is the query being answered.
+
+        Returns
+        -------
+            str
+            A hash of the query and of the fingerprints of the input files it reads and of this script, so that any change to one of
+            them gives a different key.
+    """
+    parts = [tuple(spec), file_fingerprint(__file__)]
+    for key in query_inputs(spec):
+        parts.append(file_fingerprint(arguments[key.upper()]))
+
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def evict_results(results_dir, max_size):
+    """Parameters
+        ----------
+            results_dir : str
+            max_size : int
+
+            results_dir is the directory of cached results and max_size the number of bytes it may hold. The least recently used files are
+            deleted until the directory fits (a hit touches the files it used).
+
+        Returns
+        -------
+            int
+            The number of files deleted.
+    """
+    entries = []
+    total_size = 0
+    for entry in os.scandir(results_dir):
+        if (entry.name not in ('stats.json', 'stats.lock') and not entry.name.endswith('.tmp')):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+    evictions = 0
+    for _, size, path in sorted(entries):
+        if (total_size <= max_size):
+            break
+        os.remove(path)
+        total_size -= size
+        evictions += 1
+
+    return evictions
+
+
+def update_result_stats(results_dir, hits=0, misses=0, evictions=0):
+    """Parameters
+        ----------
+            results_dir : str
+            hits : int
+            misses : int
+            evictions : int
+
+            Adds the given counts to the statistics stored in results_dir/stats.json. Concurrent runs take turns through a lock on
+            results_dir/stats.lock, the file is replaced at once so it is never read half written, and a file that cannot be read counts as
+            no statistics.
+
+        Returns
+        -------
+            dict
+            The updated statistics.
+    """
+    stats_file = os.path.join(results_dir, 'stats.json')
+    os.makedirs(results_dir, exist_ok=True)
+
+    with open(os.path.join(results_dir, 'stats.lock'), 'w') as lock:
+        if (fcntl is not None):
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        try:
+            with open(stats_file, 'r') as f:
+                stats.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+        stats['hits'] += hits
+        stats['misses'] += misses
+        stats['evictions'] += evictions
+
+        temporary_file = stats_file + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary_file, 'w') as f:
+            json.dump(stats, f)
+        os.replace(temporary_file, stats_file)
+
+    return stats
+
+
+def print_result_stats(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments, used to find the cache directory.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does print the result cache statistics.
+    """
+    results_dir = os.path.join(arguments.get('CACHE_DIR', '.route_cache'), 'results')
+    stats = update_result_stats(results_dir)
+    files = [entry for entry in os.scandir(results_dir) if entry.name not in ('stats.json', 'stats.lock')]
+    lookups = stats['hits'] + stats['misses']
+
+    print('Result cache: ' + results_dir)
+    print('  hits:      ' + str(stats['hits']) + (' (' + format(stats['hits'] / lookups, '.1%') + ')' if lookups else ''))
+    print('  misses:    ' + str(stats['misses']))
+    print('  evictions: ' + str(stats['evictions']))
+    print('  size:      ' + str(sum(entry.stat().st_size for entry in files)) + ' bytes in ' + str(len(files)) + ' files')
+
+
+def start_instrumentation(trace_memory=True):
+    """Parameters
+        ----------
+            trace_memory : bool
+
+            Whether tracemalloc traces the memory allocated by every phase, at the cost of a slower run.
+
+        Returns
+        -------
+            list
+            The list every phase run from now on is recorded in by measure_phase, see write_phases. A later call starts a new list.
+    """
+    # Imported here so that runs without INSTRUMENT never pay for importing tracemalloc
+    import tracemalloc
+
+    global _phases
+    _phases = []
+    if (trace_memory and not tracemalloc.is_tracing()):
+        tracemalloc.start()
+
+    return _phases
+
+
+@contextlib.contextmanager
+def measure_phase(name, rows=None):
+    """Parameters
+        ----------
+            name : str
+            rows : int
+
+            The name of the phase run inside the with block and the number of rows it works on, which the block can also set later through
+            the rows item of the yielded record.
+
+        Returns
+        -------
+            dict
+            The record of the phase, yielded to the with block. Once the block ends it holds the phase (its name prefixed with the names of
+            the phases it runs in), its depth, wall_seconds, cpu_seconds, traced_peak_bytes (the most memory traced by tracemalloc during the
+            phase above what was traced when it started, None when memory is not traced), max_rss_bytes (the peak resident set size of the
+            process so far, None when the platform does not report it) and rows. Nothing is measured unless start_instrumentation was called,
+            and phases run in other threads than the main one are only measured as part of the phase they run in.
+    """
+    if (_phases is None or threading.current_thread() is not threading.main_thread()):
+        yield {'rows': rows}
+        return
+
+    # Already imported by start_instrumentation
+    import tracemalloc
+
+    record = {'phase': '/'.join([parent['name'] for parent in _phase_stack] + [name]), 'depth': len(_phase_stack), 'rows': rows}
+    _phases.append(record)
+    tracing = tracemalloc.is_tracing()
+    if (tracing):
+        current, peak = tracemalloc.get_traced_memory()
+        # The peak is reset for every phase, so the phase it interrupts keeps the peak it reached so far
+        if (_phase_stack):
+            _phase_stack[-1]['peak'] = max(_phase_stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+    else:
+        current = 0
+    state = {'name': name, 'peak': current}
+    _phase_stack.append(state)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.process_time() - cpu_start
+        _phase_stack.pop()
+        if (tracing):
+            peak = max(state['peak'], tracemalloc.get_traced_memory()[1])
+            record['traced_peak_bytes'] = peak - current
+            if (_phase_stack):
+                _phase_stack[-1]['peak'] = max(_phase_stack[-1]['peak'], peak)
+        else:
+            record['traced_peak_bytes'] = None
+        if (resource is None):
+            record['max_rss_bytes'] = None
+        else:
+            # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+            record['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def report_phases(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments: INSTRUMENT is json or table and INSTRUMENT_FILE the file JSON lines are written to.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does write one JSON line per measured phase, or a table summing the phases with
+            the same name, to stderr unless INSTRUMENT_FILE is given.
+    """
+    if (arguments.get('INSTRUMENT_FILE')):
+        with open(arguments['INSTRUMENT_FILE'], 'w') as f:
+            write_phases(f, arguments['INSTRUMENT'] == "json")
+    else:
+        write_phases(sys.stderr, arguments['INSTRUMENT'] == "json")
+
+
+def write_phases(output, as_json):
+    """Parameters
+        ----------
+            output : file
+            as_json : bool
+
+            The text file the measured phases are written to, as JSON lines when as_json is True and as a table otherwise.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does write the phases to output.
+    """
+    if (as_json):
+        for record in _phases:
+            output.write(json.dumps(record) + '\n')
+        return
+
+    totals = {}
+    for record in _phases:
+        total = totals.setdefault(record['phase'], {'depth': record['depth'], 'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                    'traced_peak_bytes': None, 'max_rss_bytes': None, 'rows': None})
+        total['calls'] += 1
+        total['wall_seconds'] += record['wall_seconds']
+        total['cpu_seconds'] += record['cpu_seconds']
+        for column in ('traced_peak_bytes', 'max_rss_bytes'):
+            if (record[column] is not None):
+                total[column] = max(total[column] or 0, record[column])
+        if (record['rows'] is not None):
+            total['rows'] = (total['rows'] or 0) + record['rows']
+
+    print(format('phase', '<52') + format('calls', '>6') + format('wall s', '>10') + format('cpu s', '>10') + format('traced MiB', '>12')
+          + format('rss MiB', '>10') + format('rows', '>12'), file=output)
+    for phase, total in totals.items():
+        print(format('  ' * total['depth'] + phase.rsplit('/', 1)[-1], '<52') + format(total['calls'], '>6')
+              + format(total['wall_seconds'], '>10.3f') + format(total['cpu_seconds'], '>10.3f')
+              + ('' if total['traced_peak_bytes'] is None else format(total['traced_peak_bytes'] / 2 ** 20, '>12.1f')).rjust(12)
+              + ('' if total['max_rss_bytes'] is None else format(total['max_rss_bytes'] / 2 ** 20, '>10.1f')).rjust(10)
+              + ('' if total['rows'] is None else format(total['rows'], '>12')).rjust(12), file=output)
+
+
+def draw_chart(grouped_df, question, spec, graph_type, pdf, copy_name=None):
+    """Parameters
+        ----------
+            grouped_df : pandas Dataframe
+            question : str
+            spec : QuerySpec
+            graph_type : str
+            pdf : str or file
+            copy_name : str
+
+            grouped_df is the answer to spec, graph_type is bar or pie and pdf is the file name or binary file the chart is written to.
+            The predefined questions use their labels from CHARTS (see is_predefined_chart), the labels of any other query are generated
+            from its spec.
+            When copy_name is given the chart is also copied there once it is written.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does write the chart to pdf.
+    """
+    with measure_phase('chart:' + graph_type, len(grouped_df)):
+        # Imported here so that runs without charts never pay for importing matplotlib
+        from matplotlib.figure import Figure
+
+        if (is_predefined_chart(question, spec)):
+            bar_arguments, pie_arguments = [tuple(label.format(limit=spec.limit) if isinstance(label, str) else label for label in arguments)
+                                            for arguments in CHARTS[question]]
+        else:
+            title = describe_query(spec)
+            bar_arguments = (6, 6, GROUP_BY_LABELS[spec.group_by], METRIC_LABELS[spec.metric], title)
+            pie_arguments = (6, 6, title)
+
+        if (grouped_df.empty):
+            # pandas cannot plot a DataFrame without rows, so draw the titled axes alone
+            figure = Figure(figsize=pie_arguments[:2])
+            axes = figure.subplots()
+            axes.set_title(pie_arguments[2])
+            axes.text(0.5, 0.5, 'No routes match this query', ha='center', va='center')
+            axes.set_axis_off()
+            figure.savefig(pdf, format='pdf')
+        elif (graph_type == "bar"):
+            create_bar(grouped_df, 'subject', 'statistic', *bar_arguments, pdf)
+        else:
+            create_pie(grouped_df, 'subject', 'statistic', *pie_arguments, pdf)
+
+        if (copy_name is not None):
+            store_copy(pdf, copy_name)
+
+
+def is_predefined_chart(question, spec):
+    """Parameters
+        ----------
+            question : str
+            spec : QuerySpec
+
+            The name of an answer and the query it answers.
+
+        Returns
+        -------
+            bool
+            True if question is one of CHARTS and spec is that question apart from its limit, so the chart gets its labels from CHARTS.
+            Any other query named like a question gets generated labels.
+    """
+    return question in CHARTS and spec._replace(limit=QUESTIONS[question].limit) == QUESTIONS[question]
+
+
+def file_fingerprint(file_name):
+    """Parameters
+        ----------
+            file_name : str
+
+            The path of an input file.
+
+        Returns
+        -------
+            tuple
+            The absolute path, size in bytes and modification time in nanoseconds of file_name. Any change to the file changes its fingerprint.
+    """
+    stat = os.stat(file_name)
+    return (os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+
+
+def read_yaml_dataset(file_name, key, columns=None, where=None, decompress_thread=False):
+    """Parameters
+        ----------
+            file_name : str
+            key : str
+            columns : list
+            where : dict
+            decompress_thread : bool
+
+            file_name is the path of a YAML input file and key is the name of the top level list inside of it (airlines, airports or routes).
+            columns and where select the fields and records to read, see stream_records, and decompress_thread is passed to open_input.
+
+        Returns
+        -------
+            pandas Dataframe
+            The records stored under key in file_name, read by read_yaml_chunks.
+    """
+    chunks = list(read_yaml_chunks(file_name, key, columns=columns, where=where, decompress_thread=decompress_thread))
+    if (len(chunks) == 1):
+        return chunks[0]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_yaml_chunks(file_name, key, chunk_size=CHUNK_SIZE, columns=None, where=None, decompress_thread=False):
+    """Parameters
+        ----------
+            file_name : str
+            key : str
+            chunk_size : int
+            columns : list
+            where : dict
+            decompress_thread : bool
+
+            file_name is the path of a YAML input file and key is the name of the top level list inside of it (airlines, airports or routes).
+            The file is read as a stream of parser events instead of being loaded as one document, and the records are collected in column
+            buffers that are turned into a DataFrame every chunk_size rows, so the whole file never exists as a list of Python dicts.
+            columns and where select the fields and records to read (see stream_records), every one of columns is then in the DataFrames
+            even when no record has it. The file is opened by open_input, which decompresses it in a background thread when
+            decompress_thread is True.
+
+        Returns
+        -------
+            generator
+            DataFrames of at most chunk_size records stored under key in file_name, in file order. A file without records gives one empty
+            DataFrame.
+    """
+    buffers = {column: [] for column in columns or ()}
+    rows = 0
+    chunks = 0
+
+    with open_input(file_name, decompress_thread) as f:
+        for record in stream_records(f, key, columns, where):
+            for column, value in record.items():
+                if (column not in buffers):
+                    buffers[column] = [None] * rows
+                buffers[column].append(value)
+            rows += 1
+            for buffer in buffers.values():
+                if (len(buffer) < rows):
+                    buffer.append(None)
+
+            if (rows == chunk_size):
+                with measure_phase('dataframe_build', rows):
+                    chunk_df = pd.DataFrame(buffers).infer_objects()
+                yield chunk_df
+                chunks += 1
+                buffers = {column: [] for column in buffers}
+                rows = 0
+
+    if (rows > 0):
+        with measure_phase('dataframe_build', rows):
+            chunk_df = pd.DataFrame(buffers).infer_objects()
+        yield chunk_df
+    elif (not chunks):
+        # Empty columns would otherwise be float, which the string methods of normalize_dataset reject
+        yield pd.DataFrame(buffers, dtype=object)
+
+
+def open_input(file_name, decompress_thread=False):
+    """Parameters
+        ----------
+            file_name : str
+            decompress_thread : bool
+
+            file_name is the path of an input file, plain text or compressed with one of the formats of COMPRESSION_MAGIC, which is found
+            from the first bytes of the file and not from its extension. zstd needs the zstandard package.
+            When decompress_thread is True a compressed file is decompressed by a DecompressionReader, in a thread that runs ahead of the
+            reader, instead of by the reads themselves.
+
+        Returns
+        -------
+            file
+            file_name opened for reading as text, decompressed block by block as it is read so it is never decompressed to disk or memory
+            as a whole.
+    """
+    with open(file_name, 'rb') as f:
+        magic = f.read(6)
+    compression = next((name for prefix, name in COMPRESSION_MAGIC.items() if magic.startswith(prefix)), None)
+
+    if (compression is None):
+        return open(file_name, 'r')
+    if (compression == 'gzip'):
+        stream = gzip.open(file_name, 'rb')
+    elif (compression == 'xz'):
+        stream = lzma.open(file_name, 'rb')
+    elif (compression == 'bz2'):
+        stream = bz2.open(file_name, 'rb')
+    elif (importlib.util.find_spec('zstandard')):
+        import zstandard
+        stream = zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'), read_across_frames=True, closefd=True)
+    else:
+        raise ValueError(file_name + ' is compressed with zstd, which needs zstandard, which is not installed')
+
+    if (decompress_thread):
+        stream = io.BufferedReader(DecompressionReader(stream), DECOMPRESS_BLOCK_SIZE)
+    return io.TextIOWrapper(stream)
+
+
+class DecompressionReader(io.RawIOBase):
+    """Reads a decompressing file in a background thread, so the file is read and decompressed while the caller parses what came before"""
+
+    def __init__(self, stream) -> None:
+        """
+        DecompressionReader constructor creates an instance of DecompressionReader when the class is called and starts its thread
+        Parameters
+        ----------
+            self: DecompressionReader (refers to the instance of the class being operated on)
+            stream: binary file (the decompressing file, read DECOMPRESS_BLOCK_SIZE bytes at a time and closed with the reader)
+
+        Returns
+        -------
+            None
+        """
+        super().__init__()
+        self.__stream = stream
+        self.__blocks: queue.Queue = queue.Queue(DECOMPRESS_QUEUE_BLOCKS)
+        self.__block: memoryview = memoryview(b'')
+        self.__finished: bool = False
+        self.__stopped: threading.Event = threading.Event()
+        self.__thread: threading.Thread = threading.Thread(target=self.__decompress, daemon=True)
+        self.__thread.start()
+
+    def __decompress(self) -> None:
+        """
+        __decompress method runs in the thread, it queues the blocks of the file followed by an empty block, or the error that stopped it
+        Parameters
+        ----------
+            self: DecompressionReader (refers to the instance of the class being operated on)
+
+        Returns
+        -------
+            None
+        """
+        try:
+            block = None
+            while (block != b'' and not self.__stopped.is_set()):
+                block = self.__stream.read(DECOMPRESS_BLOCK_SIZE)
+                self.__queue(block)
+        except Exception as error:
+            self.__queue(error)
+
+    def __queue(self, item) -> None:
+        """
+        __queue method waits for room in the queue for item, giving up when the reader is closed
+        Parameters
+        ----------
+            self: DecompressionReader (refers to the instance of the class being operated on)
+            item: bytes or Exception (a block of the file or the error raised while reading it)
+
+        Returns
+        -------
+            None
+        """
+        while (not self.__stopped.is_set()):
+            try:
+                self.__blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        """
+        readinto method copies the next decompressed bytes into buffer, waiting for the thread when it has not decompressed them yet
+        Parameters
+        ----------
+            self: DecompressionReader (refers to the instance of the class being operated on)
+            buffer: writable buffer (filled from the start)
+
+        Returns
+        -------
+            int (number of bytes copied, 0 at the end of the file)
+        """
+        while (not self.__block and not self.__finished):
+            item = self.__blocks.get()
+            if (isinstance(item, Exception)):
+                self.__finished = True
+                raise item
+            self.__finished = not item
+            self.__block = memoryview(item)
+
+        size = min(len(buffer), len(self.__block))
+        buffer[:size] = self.__block[:size]
+        self.__block = self.__block[size:]
+        return size
+
+    def close(self) -> None:
+        """
+        close method stops the thread and closes the decompressing file
+        Parameters
+        ----------
+            self: DecompressionReader (refers to the instance of the class being operated on)
+
+        Returns
+        -------
+            None
+        """
+        if (not self.closed):
+            self.__stopped.set()
+            self.__thread.join()
+            self.__stream.close()
+        super().close()
+
+
+def stream_records(stream, key, columns=None, where=None):
+    """Parameters
+        ----------
+            stream : file
+            key : str
+            columns : list
+            where : dict
+
+            stream is an open YAML file and key is the name of the top level list to read from it. The file is walked event by event using
+            the LibYAML parser when PyYAML was built with it, and only the mappings found in the list under key are built.
+            When columns is given the other fields of every record are skipped without resolving their values. where maps fields (which
+            must be in columns) to predicates called with their resolved value, or None when the record does not have the field, and the
+            records for which one of them is false are dropped before they reach the caller.
+
+        Returns
+        -------
+            generator
+            Yields one dict per record of the list, with scalars resolved the same way yaml.safe_load resolves them.
+    """
+    wanted = None if columns is None else set(columns)
+    tests = list(where.items()) if where else []
+    events = yaml.parse(stream, Loader=YAML_LOADER)
+
+    for event in events:
+        if (isinstance(event, yaml.MappingStartEvent)):
+            break
+
+    for event in events:
+        if (isinstance(event, yaml.MappingEndEvent)):
+            return
+        if (isinstance(event, yaml.ScalarEvent) and event.value == key):
+            event = next(events)
+            if (not isinstance(event, yaml.SequenceStartEvent)):
+                skip_node(event, events)
+                continue
+            for event in events:
+                if (isinstance(event, yaml.SequenceEndEvent)):
+                    break
+                if (not isinstance(event, yaml.MappingStartEvent)):
+                    skip_node(event, events)
+                    continue
+                record = {}
+                for event in events:
+                    if (isinstance(event, yaml.MappingEndEvent)):
+                        break
+                    value = next(events)
+                    column = resolve_scalar(event)
+                    if (wanted is not None and column not in wanted):
+                        skip_node(value, events)
+                    elif (isinstance(value, yaml.ScalarEvent)):
+                        record[column] = resolve_scalar(value)
+                    else:
+                        skip_node(value, events)
+                        record[column] = None
+                if (all(test(record.get(column)) for column, test in tests)):
+                    yield record
+        else:
+            # Skip the key and then the whole value of any other top level entry
+            skip_node(event, events)
+            skip_node(next(events), events)
+
+
+def skip_node(event, events):
+    """Parameters
+        ----------
+            event : yaml Event
+            events : generator
+
+            event is the first event of a YAML node and events is the generator it came from. Consumes the rest of the node from events.
+
+        Returns
+        -------
+            None
+            This function does not return anything.
+    """
+    depth = 1 if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)) else 0
+    while (depth > 0):
+        event = next(events)
+        if (isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent))):
+            depth += 1
+        elif (isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent))):
+            depth -= 1
+
+
+def resolve_scalar(event):
+    """Parameters
+        ----------
+            event : yaml ScalarEvent
+
+            A scalar parsed from a YAML file.
+
+        Returns
+        -------
+            object
+            The value of the scalar, typed the way yaml.safe_load would type it (quoted scalars are always strings).
+    """
+    tag = event.tag
+    if (tag is None or tag == '!'):
+        tag = _yaml_resolver.resolve(yaml.ScalarNode, event.value, event.implicit)
+    if (tag == STRING_TAG):
+        return event.value
+
+    return yaml.SafeLoader.yaml_constructors[tag](_yaml_constructor, yaml.ScalarNode(tag, event.value))
+
+
+def load_datasets(arguments, keys):
+    """Parameters
+        ----------
+            arguments : dict
+            keys : list
+
+            arguments is the dictionary of command line arguments and keys are the datasets to load (see load_dataset).
+            The datasets not loaded yet are loaded at the same time when more than one of them has to be parsed and LOAD_WORKERS (default
+            one per CPU) is more than 1: every dataset is loaded by its own thread, which reads the input cache, while the parsing is done
+            in a pool of LOAD_WORKERS worker processes at most, so the load takes as long as the largest file instead of all of them.
+
+        Returns
+        -------
+            dict
+            The DataFrame of every key, once every one of them is loaded.
+    """
+    missing = [key for key in keys if (arguments[key.upper()], key) not in _loaded_frames]
+    if (arguments.get('CACHE', 'yes') == "no" or arguments.get('OUT_OF_CORE', 'no') == "yes"):
+        # The routes filter of a query pushed down with a country needs the airports, which are then loaded first. Cached loads parse
+        # without the filter, so their airports are loaded with the other datasets
+        for key in missing:
+            load_filter(arguments, key)
+        missing = [key for key in missing if (arguments[key.upper()], key) not in _loaded_frames]
+
+    parsed = [key for key in missing if arguments.get('CACHE', 'yes') == "no" or arguments.get('REBUILD_CACHE', 'no') == "yes"
+              or not os.path.exists(input_cache_file(arguments, arguments[key.upper()], key)[1])]
+    workers = min(int(arguments.get('LOAD_WORKERS', os.cpu_count())), len(parsed))
+    if (len(missing) > 1 and workers > 1):
+        # Imported here so that runs loading their datasets one at a time never pay for importing the worker pools
+        import concurrent.futures
+        import tracemalloc
+
+        with measure_phase('load:' + ','.join(missing)) as phase:
+            with concurrent.futures.ProcessPoolExecutor(workers, initializer=tracemalloc.stop) as processes:
+                # Start the workers before the threads, a process forked while threads run may inherit locks they were holding
+                processes.submit(os.getpid).result()
+                with concurrent.futures.ThreadPoolExecutor(len(missing)) as threads:
+                    futures = [threads.submit(load_dataset, arguments, key, processes) for key in missing]
+                    phase['rows'] = sum(len(future.result()) for future in futures)
+
+    return {key: load_dataset(arguments, key) for key in keys}
+
+
+def load_dataset(arguments, key, processes=None):
+    """Parameters
+        ----------
+            arguments : dict
+            key : str
+            processes : concurrent.futures Executor
+
+            arguments is the dictionary of command line arguments and key is the dataset to load (airlines, airports or routes), which is read
+            from the file given by the matching argument (AIRLINES, AIRPORTS or ROUTES).
+            Each file is parsed only once per process, every later call for the same file returns the same DataFrame, so the questions must
+            not modify the returned DataFrame in place. The DataFrame is normalized by normalize_dataset before it is returned.
+            Unless --CACHE="no" is given, the parsed DataFrame is also stored in a binary cache (CACHE_DIR, default .route_cache) keyed on
+            the path, size and modification time of the file, so later runs skip YAML parsing.
+            --REBUILD_CACHE="yes" parses the file again and replaces its cache entry. Only the fields of LOAD_COLUMNS are kept, and with
+            --CACHE="no" the fields and records load_filter selects for the query pushed down by push_down_query. The file is parsed in
+            processes when it is given (see load_datasets).
+
+        Returns
+        -------
+            pandas Dataframe
+            The records stored under key in the input file.
+    """
+    file_name = arguments[key.upper()]
+
+    if ((file_name, key) not in _loaded_frames):
+        _loaded_fingerprints[(file_name, key)] = file_fingerprint(file_name)
+        with measure_phase('load:' + key) as phase:
+            if (arguments.get('CACHE', 'yes') == "no"):
+                _loaded_frames[(file_name, key)] = parse_dataset_in(processes, file_name, key, *load_filter(arguments, key),
+                                                                    arguments.get('DECOMPRESS_THREAD', 'no') == "yes")
+            else:
+                _loaded_frames[(file_name, key)] = load_cached_dataset(arguments, file_name, key, processes)
+            phase['rows'] = len(_loaded_frames[(file_name, key)])
+
+    return _loaded_frames[(file_name, key)]
+
+
+def stream_dataset(arguments, key):
+    """Parameters
+        ----------
+            arguments : dict
+            key : str
+
+            arguments is the dictionary of command line arguments and key is the dataset to stream (airlines, airports or routes), read from
+            the file given as the upper case key. CHUNK_SIZE in arguments sets the number of records per chunk. Only the fields and records
+            load_filter selects are read.
+
+        Returns
+        -------
+            generator
+            The dataset as normalized DataFrame chunks (see read_yaml_chunks), so it is never held in memory as a whole. The file is
+            remembered as loaded, forget_changed_datasets then drops what was derived from it when it changes.
+    """
+    file_name = arguments[key.upper()]
+    _loaded_fingerprints[(file_name, key)] = file_fingerprint(file_name)
+    columns, where = load_filter(arguments, key)
+    for chunk_df in read_yaml_chunks(file_name, key, int(arguments.get('CHUNK_SIZE', CHUNK_SIZE)), columns, where,
+                                     arguments.get('DECOMPRESS_THREAD', 'no') == "yes"):
+        yield normalize_dataset(chunk_df, key)
+
+
+def push_down_query(spec):
+    """Parameters
+        ----------
+            spec : QuerySpec
+
+            The only query the run answers, or None when it answers several.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but the datasets parsed from now on only hold what spec reads (see load_filter).
+    """
+    global _pushed_query
+    _pushed_query = spec
+
+
+def load_filter(arguments, key):
+    """Parameters
+        ----------
+            arguments : dict
+            key : str
+
+            arguments is the dictionary of command line arguments and key is the dataset about to be parsed (airlines, airports or routes).
+            Every dataset is projected to its LOAD_COLUMNS. When push_down_query was given a query that is not a GRAPH_METRICS one, the
+            routes are also projected to the ends the query is answered from (see plan_query, every end when OUT_OF_CORE counts them all)
+            and the routes whose filtered ends are outside spec.country are dropped, which loads the airports first. The airports outside
+            spec.country are dropped too when every airport end of the query is filtered by it. The records dropped are the ones the
+            joins of run_query would drop, so the answer does not change.
+
+        Returns
+        -------
+            tuple
+            The columns and where arguments of stream_records for key. The predicates can be pickled, so they are also applied by the
+            worker processes of load_datasets.
+    """
+    spec = _pushed_query
+    if (spec is None or spec.metric in GRAPH_METRICS):
+        return LOAD_COLUMNS[key], None
+
+    if (spec.metric == 'altitude_difference'):
+        ends = ('origin_id', 'destination_id')
+    elif (arguments.get('OUT_OF_CORE', 'no') == "yes"):
+        ends = tuple(ROUTE_COLUMNS)
+    else:
+        ends = plan_query(spec)
+    filtered = [end for end in ('origin_id', 'destination_id') if end in ends and spec.country and spec.direction in (end[:-3], 'both')]
+
+    if (key == 'airports' and filtered and len(filtered) == len([end for end in ends if end != 'airline_id'])):
+        country = spec.country.strip()
+        # The same comparison as country_airports, made on the value before normalize_dataset strips it
+        return LOAD_COLUMNS[key], {'airport_country': functools.partial(is_country, country)}
+    if (key != 'routes'):
+        return LOAD_COLUMNS[key], None
+
+    where = None
+    if (filtered):
+        labels_df = airport_labels(arguments)
+        airport_ids = set(labels_df['airport_id'].iloc[country_airports(arguments, spec.country)].dropna().astype(int).tolist())
+        where = {ROUTE_COLUMNS[end]: functools.partial(is_airport_in, airport_ids) for end in filtered}
+    return [ROUTE_COLUMNS[end] for end in ends], where
+
+
+def is_country(country, value):
+    """Parameters
+        ----------
+            country : str
+            value : object
+
+            country is the stripped name of a country and value the country of an airport as it was read from YAML.
+
+        Returns
+        -------
+            bool
+            True if value is country, compared like country_airports compares them once normalize_dataset has stripped value.
+    """
+    return value is not None and str(value).strip() == country
+
+
+def is_airport_in(airport_ids, value):
+    """Parameters
+        ----------
+            airport_ids : set
+            value : object
+
+            airport_ids are integer airport IDs and value an airport ID of a route as it was read from YAML.
+
+        Returns
+        -------
+            bool
+            True if value, converted to the integer normalize_dataset converts it to, is one of airport_ids. Values that are not numbers
+            are not in it.
+    """
+    try:
+        return round(float(value)) in airport_ids
+    except (TypeError, ValueError, OverflowError):
+        return False
+
+
+def parse_dataset_in(processes, file_name, key, columns=None, where=None, decompress_thread=False):
+    """Parameters
+        ----------
+            processes : concurrent.futures Executor
+            file_name, key, columns, where, decompress_thread : the arguments of parse_dataset
+
+            processes runs parse_dataset, which runs in this process instead when processes is None.
+
+        Returns
+        -------
+            pandas Dataframe
+            The DataFrame of parse_dataset, once it is parsed.
+    """
+    if (processes is None):
+        return parse_dataset(file_name, key, columns, where, decompress_thread)
+    return processes.submit(parse_dataset, file_name, key, columns, where, decompress_thread).result()
+
+
+def parse_dataset(file_name, key, columns=None, where=None, decompress_thread=False):
+    """Parameters
+        ----------
+            file_name : str
+            key : str
+            columns : list
+            where : dict
+            decompress_thread : bool
+
+            The YAML file to parse and the top level key of its list of records (airlines, airports or routes). columns and where select
+            the fields and records to read, see stream_records, and decompress_thread is passed to open_input.
+
+        Returns
+        -------
+            pandas Dataframe
+            The records of file_name read by read_yaml_dataset and converted by normalize_dataset.
+    """
+    with measure_phase('parse') as phase:
+        dataframe = read_yaml_dataset(file_name, key, columns, where, decompress_thread)
+        phase['rows'] = len(dataframe)
+    with measure_phase('normalize', len(dataframe)):
+        return normalize_dataset(dataframe, key)
+
+
+def normalize_dataset(dataframe, key):
+    """Parameters
+        ----------
+            dataframe : pandas Dataframe
+            key : str
+
+            dataframe holds the records of the dataset named key (airlines, airports or routes) as they were read from YAML.
+            The join keys listed in ID_COLUMNS are converted to 32 bit integers (nullable when some IDs are not numbers, so they still join
+            with each other), the text listed in TEXT_COLUMNS is stripped of surrounding whitespace with one vectorized pass over each column
+            and the repeated strings listed in CATEGORY_COLUMNS become categoricals, which makes the merges and groupbys of the questions
+            faster and the DataFrame several times smaller.
+
+        Returns
+        -------
+            pandas Dataframe
+            dataframe with the converted columns.
+    """
+    dataframe = dataframe.copy()
+
+    for column in ID_COLUMNS[key]:
+        if (column in dataframe.columns):
+            ids = pd.to_numeric(dataframe[column], errors='coerce')
+            if (ids.isna().any()):
+                # Keep the IDs that are not numbers as missing values instead of failing, as strings they never matched a number either
+                dataframe[column] = ids.round().astype('Int64' if ids.abs().max() > np.iinfo(np.int32).max else 'Int32')
+            else:
+                dataframe[column] = ids.astype(np.int64 if ids.abs().max() > np.iinfo(np.int32).max else np.int32)
+
+    for column in TEXT_COLUMNS[key]:
+        if (column in dataframe.columns):
+            # .str gives NaN for values that are not strings (numbers read from YAML), those are kept as they were
+            stripped = dataframe[column].str.strip()
+            dataframe[column] = stripped.where(stripped.notna(), dataframe[column])
+
+    for column in CATEGORY_COLUMNS[key]:
+        if (column in dataframe.columns):
+            dataframe[column] = dataframe[column].astype('category')
+
+    return dataframe
+
+
+def forget_datasets():
+    """Parameters
+        ----------
+            None
+            No parameters needed for this function.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does drop every loaded DataFrame and everything derived from them, so the
+            next load_dataset call for any file reads it again.
+    """
+    _loaded_frames.clear()
+    _loaded_fingerprints.clear()
+    _derived_frames.clear()
+
+
+def forget_changed_datasets():
+    """Parameters
+        ----------
+            None
+            No parameters needed for this function.
+
+            Drops every DataFrame whose input file was modified since it was loaded (or streamed, see stream_dataset), so the next
+            load_dataset call for it reads the new file.
+
+        Returns
+        -------
+            bool
+            True if at least one DataFrame was dropped.
+    """
+    changed = False
+    for file_name, key in list(_loaded_fingerprints):
+        try:
+            current = file_fingerprint(file_name)
+        except OSError:
+            # The file is being replaced, keep serving the old data until the new one is in place
+            continue
+        if (current != _loaded_fingerprints[(file_name, key)]):
+            _loaded_frames.pop((file_name, key), None)
+            del _loaded_fingerprints[(file_name, key)]
+            changed = True
+
+    if (changed):
+        _derived_frames.clear()
+
+    return changed
+
+
+def count_routes(routes_df, columns):
+    """Parameters
+        ----------
+            routes_df : pandas Dataframe
+            columns : list
+
+            routes_df holds the routes and columns are the columns of routes_df to count them by. Every column is factorized to integer codes,
+            the codes are combined into one key per route and the keys are counted with np.bincount (or with np.unique when the key space is
+            much larger than the number of routes), so no Python level grouping is done.
+
+        Returns
+        -------
+            pandas Dataframe
+            One row per distinct combination of columns found in routes_df, with the combination and its number of routes in a routes column.
+    """
+    keys = np.zeros(len(routes_df), dtype=np.int64)
+    uniques = []
+    for column in columns:
+        codes, column_uniques = pd.factorize(routes_df[column], use_na_sentinel=False)
+        keys = keys * len(column_uniques) + codes
+        uniques.append(column_uniques)
+
+    key_space = int(np.prod([len(column_uniques) for column_uniques in uniques]))
+    if (key_space <= 4 * len(routes_df) + 1024):
+        counts = np.bincount(keys, minlength=key_space)
+        found = np.flatnonzero(counts)
+        counts = counts[found]
+    else:
+        found, counts = np.unique(keys, return_counts=True)
+
+    counts_df = {}
+    for column, column_uniques in reversed(list(zip(columns, uniques))):
+        found, codes = np.divmod(found, len(column_uniques))
+        counts_df[column] = column_uniques.take(codes)
+
+    counts_df = pd.DataFrame({column: counts_df[column] for column in columns})
+    counts_df['routes'] = counts
+    return counts_df
+
+
+def count_routes_parallel(routes_df, columns, workers):
+    """Parameters
+        ----------
+            routes_df : pandas Dataframe
+            columns : list
+            workers : int
+
+            The parameters of count_routes and the number of worker processes counting the routes.
+            The columns are copied once into a block of shared memory and every worker counts its own range of rows straight from it with
+            count_routes_partition, so no routes are pickled. The partial counts are then summed with sum_route_counts. The routes are
+            counted by count_routes in this process when there is one worker, when every worker would get fewer than MIN_PARTITION_SIZE
+            routes or when a column is not a plain integer column (nullable IDs).
+
+        Returns
+        -------
+            pandas Dataframe
+            The route counts of count_routes, possibly in another row order.
+    """
+    partitions = min(workers, len(routes_df) // MIN_PARTITION_SIZE)
+    if (partitions <= 1 or not all(isinstance(routes_df[column].dtype, np.dtype) and routes_df[column].dtype.kind in 'iu'
+                                   for column in columns)):
+        return count_routes(routes_df, columns)
+
+    # Imported here so that runs counting the routes in this process never pay for importing the worker pool
+    import concurrent.futures
+    from multiprocessing import shared_memory
+
+    arrays = [routes_df[column].to_numpy() for column in columns]
+    shared = shared_memory.SharedMemory(create=True, size=sum(array.nbytes for array in arrays))
+    try:
+        layout = []
+        offset = 0
+        for column, array in zip(columns, arrays):
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shared.buf, offset=offset)[:] = array
+            layout.append((column, array.dtype.str, offset))
+            offset += array.nbytes
+
+        bounds = np.linspace(0, len(routes_df), partitions + 1).astype(np.int64)
+        with concurrent.futures.ProcessPoolExecutor(partitions) as pool:
+            futures = [pool.submit(count_routes_partition, shared.name, layout, len(routes_df), int(start), int(stop))
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            counts_dfs = [future.result() for future in futures]
+    finally:
+        shared.close()
+        shared.unlink()
+
+    return sum_route_counts(pd.concat(counts_dfs, ignore_index=True), columns)
+
+
+def count_routes_partition(shared_name, layout, rows, start, stop):
+    """Parameters
+        ----------
+            shared_name : str
+            layout : list
+            rows : int
+            start : int
+            stop : int
+
+            shared_name is the block of shared memory holding the route columns, layout lists the name, numpy type and byte offset of every
+            column in it and rows is the length of the columns. The routes from start to stop are counted, in a worker process of
+            count_routes_parallel.
+
+        Returns
+        -------
+            pandas Dataframe
+            The route counts of count_routes for those routes.
+    """
+    from multiprocessing import shared_memory
+
+    shared = shared_memory.SharedMemory(name=shared_name)
+    try:
+        partition_df = pd.DataFrame({column: np.ndarray(rows, dtype=dtype, buffer=shared.buf, offset=offset)[start:stop]
+                                     for column, dtype, offset in layout}, copy=False)
+        counts_df = count_routes(partition_df, [column for column, _, _ in layout])
+        # The DataFrame views the shared block, which cannot be closed while it does
+        del partition_df
+        return counts_df
+    finally:
+        shared.close()
+
+
+def route_index(arguments, columns):
+    """Parameters
+        ----------
+            arguments : dict
+            columns : tuple
+
+            arguments is the dictionary of command line arguments, used to load the routes, and columns are the route ends the routes are
+            counted by, any of airline_id, origin_id and destination_id (see ROUTE_COLUMNS).
+            Each index is built once per routes file and reused by every query that needs it, so answering many queries costs one pass over
+            the routes per distinct index instead of one merge per query. With OUT_OF_CORE every index is summed from the counts by airline,
+            origin and destination of stream_route_counts instead.
+
+        Returns
+        -------
+            pandas Dataframe
+            One row per distinct combination of columns with its number of routes in a routes column.
+    """
+    index_key = ('route_index', arguments['ROUTES'], columns)
+    full_key = ('route_index', arguments['ROUTES'], tuple(ROUTE_COLUMNS))
+    if (full_key not in _derived_frames and arguments['ROUTES'] in _route_counts):
+        _derived_frames[full_key] = _route_counts[arguments['ROUTES']]
+    if (index_key not in _derived_frames and full_key not in _derived_frames and arguments.get('OUT_OF_CORE', 'no') == "yes"):
+        _derived_frames[full_key] = stream_route_counts(arguments)
+    if (index_key not in _derived_frames and full_key in _derived_frames):
+        # Counts loaded by load_route_counts or streamed by stream_route_counts, the routes are not in memory
+        with measure_phase('route_index:' + ','.join(columns), len(_derived_frames[full_key])):
+            _derived_frames[index_key] = sum_route_counts(_derived_frames[full_key], list(columns))
+    elif (index_key not in _derived_frames):
+        routes_df = load_dataset(arguments, 'routes')
+        with measure_phase('route_index:' + ','.join(columns), len(routes_df)):
+            counts_df = count_routes_parallel(routes_df, [ROUTE_COLUMNS[column] for column in columns],
+                                              int(arguments.get('AGGREGATE_WORKERS', 1)))
+        _derived_frames[index_key] = counts_df.rename(columns={ROUTE_COLUMNS[column]: column for column in columns})
+
+    return _derived_frames[index_key]
+
+
+def stream_route_counts(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments, used to stream the routes.
+
+        Returns
+        -------
+            pandas Dataframe
+            The route index by airline_id, origin_id and destination_id (see route_index), built by counting every chunk of the routes on
+            its own and folding the counts into the running totals, so the memory used depends on the chunk size and the number of distinct
+            combinations but not on the number of routes.
+    """
+    full_index = tuple(ROUTE_COLUMNS)
+    counts_df = None
+    with measure_phase('stream:routes') as phase:
+        phase['rows'] = 0
+        for chunk_df in stream_dataset(arguments, 'routes'):
+            chunk_counts_df = count_routes(chunk_df, [ROUTE_COLUMNS[column] for column in full_index])
+            chunk_counts_df = chunk_counts_df.rename(columns={ROUTE_COLUMNS[column]: column for column in full_index})
+            if (counts_df is None):
+                counts_df = chunk_counts_df
+            else:
+                counts_df = sum_route_counts(pd.concat([counts_df, chunk_counts_df], ignore_index=True), list(full_index))
+            phase['rows'] += len(chunk_df)
+
+    return counts_df
+
+
+def sum_route_counts(counts_df, columns):
+    """Parameters
+        ----------
+            counts_df : pandas Dataframe
+            columns : list
+
+            counts_df holds route counts (see route_index), possibly with several rows for the same combination, and columns are the route
+            ends to sum them by.
+
+        Returns
+        -------
+            pandas Dataframe
+            One row per distinct combination of columns with the sum of its routes in a routes column.
+    """
+    return counts_df.groupby(columns, sort=False, dropna=False, observed=True)['routes'].sum().reset_index()
+
+
+def load_route_counts(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments: ROUTE_COUNTS is the file keeping the route counts between runs and ADD_ROUTES and
+            REMOVE_ROUTES are optional routes files (in the format of ROUTES) of routes added to and removed from the feed.
+
+        Returns
+        -------
+            None
+            This function does not return anything, but it does apply the added and removed routes to the counts in ROUTE_COUNTS (built from
+            ROUTES the first time) and point ROUTES to ROUTE_COUNTS, so the routes questions are answered from the updated counts without
+            reading the full routes file. Only the delta files are parsed. A delta file whose last use was the same argument is skipped,
+            so running the same update twice does not count its routes twice, while removing a file that was added (or adding it back
+            after removing it) still applies.
+    """
+    counts_file = arguments['ROUTE_COUNTS']
+    full_index = tuple(ROUTE_COLUMNS)
+
+    if (os.path.exists(counts_file)):
+        with measure_phase('load:route_counts') as phase:
+            state = pd.read_pickle(counts_file)
+            phase['rows'] = len(state['counts'])
+        changed = False
+    else:
+        state = {'applied': [], 'counts': route_index(arguments, full_index)}
+        changed = True
+
+    for key, sign in (('ADD_ROUTES', 1), ('REMOVE_ROUTES', -1)):
+        if (key not in arguments):
+            continue
+        with open(arguments[key], 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        # Every application is kept as (ADD_ROUTES or REMOVE_ROUTES, digest) in the order they were applied. Counts files written before
+        # the argument was kept only hold the digest, those deltas are skipped whichever argument gives them
+        uses = [entry for entry in state['applied'] if (entry if isinstance(entry, str) else entry[1]) == digest]
+        if (uses and (isinstance(uses[-1], str) or uses[-1][0] == key)):
+            print(arguments[key] + ' was already applied to ' + counts_file + ' as ' + key + ', skipping it', file=sys.stderr)
+            continue
+
+        delta_df = parse_dataset(arguments[key], 'routes', LOAD_COLUMNS['routes'],
+                                 decompress_thread=arguments.get('DECOMPRESS_THREAD', 'no') == "yes")
+        with measure_phase('apply_delta', len(delta_df)):
+            delta_counts_df = count_routes(delta_df, [ROUTE_COLUMNS[column] for column in full_index])
+            delta_counts_df = delta_counts_df.rename(columns={ROUTE_COLUMNS[column]: column for column in full_index})
+            delta_counts_df['routes'] *= sign
+            counts_df = sum_route_counts(pd.concat([state['counts'], delta_counts_df], ignore_index=True), list(full_index))
+            # Removing a route that was never counted would leave a negative count, those combinations are dropped with the empty ones
+            state['counts'] = counts_df[counts_df['routes'] > 0].reset_index(drop=True)
+        state['applied'].append((key, digest))
+        changed = True
+
+    if (changed):
+        temporary_file = counts_file + '.' + str(os.getpid()) + '.tmp'
+        pd.to_pickle(state, temporary_file)
+        os.replace(temporary_file, counts_file)
+
+    # The answers cached for these counts are then keyed by the fingerprint of counts_file, which changes with every update
+    arguments['ROUTES'] = counts_file
+    _route_counts[counts_file] = state['counts']
+
+
+def airport_labels(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments, used to load the airports.
+
+        Returns
+        -------
+            pandas Dataframe
+            One row per airport with its airport_id, airport_altitude, airport_icao_unique_code and its label for every airport attribute a
+            query can be grouped by (country, airport and city). The labels are built once per airports file with vectorized string
+            concatenation, before any join, so their cost depends on the number of airports and not on the number of routes.
+    """
+    label_key = ('airport_labels', arguments['AIRPORTS'])
+    if (label_key not in _derived_frames):
+        airports_df = load_dataset(arguments, 'airports')
+        with measure_phase('labels:airports', len(airports_df)):
+            country = airports_df['airport_country'].astype(str)
+            city = airports_df['airport_city'].astype(str)
+            icao_code = airports_df['airport_icao_unique_code'].astype(str)
+            labels_df = airports_df[['airport_id', 'airport_icao_unique_code', 'airport_altitude']].copy()
+            labels_df['country'] = country
+            labels_df['airport'] = airports_df['airport_name'].astype(str) + ' (' + icao_code + '), ' + city + ', ' + country
+            labels_df['city'] = city + ', ' + country
+        _derived_frames[label_key] = labels_df
+
+    return _derived_frames[label_key]
+
+
+def country_airports(arguments, country):
+    """Parameters
+        ----------
+            arguments : dict
+            country : str
+
+            arguments is the dictionary of command line arguments, used to load the airports, and country is the exact name of a country.
+            The rows of every country are found with one groupby when the first country is looked up, later lookups are a dictionary access.
+
+        Returns
+        -------
+            numpy array
+            The airport_labels rows of the airports in country, empty when no airport is in it.
+    """
+    lookup_key = ('country_airports', arguments['AIRPORTS'])
+    if (lookup_key not in _derived_frames):
+        _derived_frames[lookup_key] = airport_labels(arguments).groupby('country', sort=False).indices
+
+    return _derived_frames[lookup_key].get(country.strip(), np.array([], dtype=np.int64))
+
+
+def route_airport_positions(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments, used to load the airports and routes.
+            The positions are computed once per pair of input files, see locate_route_airports.
+
+        Returns
+        -------
+            tuple
+            Two arrays with the airport_labels row of the origin and of the destination of every route, -1 when the airport is unknown.
+    """
+    position_key = ('route_airport_positions', arguments['AIRPORTS'], arguments['ROUTES'])
+    if (position_key not in _derived_frames):
+        airport_ids = airport_labels(arguments)['airport_id']
+        routes_df = load_dataset(arguments, 'routes')
+        with measure_phase('route_positions', len(routes_df)):
+            _derived_frames[position_key] = locate_route_airports(airport_ids, routes_df)
+
+    return _derived_frames[position_key]
+
+
+def locate_route_airports(airport_ids, routes_df):
+    """Parameters
+        ----------
+            airport_ids : pandas Series
+            routes_df : pandas Dataframe
+
+            airport_ids is the airport_id column of airport_labels and routes_df holds the routes to locate.
+            The airport IDs of the routes are mapped to rows of airport_labels through an array indexed by airport ID when the IDs are small
+            non-negative integers, and through a hash index otherwise. When several airports share an ID the first one is used.
+
+        Returns
+        -------
+            tuple
+            Two arrays with the airport_labels row of the origin and of the destination of every route, -1 when the airport is unknown.
+    """
+    first_rows = np.flatnonzero(~airport_ids.duplicated().to_numpy())
+    unique_ids = airport_ids.iloc[first_rows]
+
+    positions = []
+    for column in ('route_from_aiport_id', 'route_to_airport_id'):
+        route_ids = routes_df[column]
+        dense = (isinstance(unique_ids.dtype, np.dtype) and unique_ids.dtype.kind in 'iu' and isinstance(route_ids.dtype, np.dtype)
+                 and route_ids.dtype.kind in 'iu' and len(unique_ids) > 0 and unique_ids.min() >= 0
+                 and unique_ids.max() <= 4 * len(unique_ids) + 1024)
+        if (dense):
+            lookup = np.full(int(unique_ids.max()) + 1, -1, dtype=np.int64)
+            lookup[unique_ids.to_numpy()] = first_rows
+            route_ids = route_ids.to_numpy()
+            known = (route_ids >= 0) & (route_ids < len(lookup))
+            column_positions = np.full(len(route_ids), -1, dtype=np.int64)
+            column_positions[known] = lookup[route_ids[known]]
+        else:
+            indexer = pd.Index(unique_ids).get_indexer(route_ids)
+            column_positions = np.where(indexer >= 0, first_rows[indexer], -1)
+        positions.append(column_positions)
+
+    return tuple(positions)
+
+
+def airline_labels(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments, used to load the airlines.
+
+        Returns
+        -------
+            pandas Dataframe
+            One row per airline with its airline_id and its airline label, built once per airlines file.
+    """
+    label_key = ('airline_labels', arguments['AIRLINES'])
+    if (label_key not in _derived_frames):
+        airlines_df = load_dataset(arguments, 'airlines')
+        with measure_phase('labels:airlines', len(airlines_df)):
+            labels_df = airlines_df[['airline_id']].copy()
+            labels_df['airline'] = airlines_df['airline_name'].astype(str) + ' (' + airlines_df['airline_icao_unique_code'] + ')'
+        _derived_frames[label_key] = labels_df
+
+    return _derived_frames[label_key]
+
+
+def search_names(arguments, text, limit=10):
+    """Parameters
+        ----------
+            arguments : dict
+            text : str
+            limit : int
+
+            arguments is the dictionary of command line arguments, used to load the search index, text is what was typed so far and limit is
+            the number of matches to return.
+            The terms of search_index starting with text are found with two binary searches. When fewer than limit airports and airlines
+            match that way, the terms sharing the most trigrams with text are added as approximate matches, so typing mistakes still find
+            them.
+
+        Returns
+        -------
+            pandas Dataframe
+            The subject (airport or airline label) and statistic (match score) of the best matches. Prefix matches score between 1 and 2,
+            2 for an exact match, and approximate matches below 1 (the Dice similarity of their trigrams).
+    """
+    index = search_index(arguments)
+    query = normalize_search_text(text)
+    scores = np.zeros(len(index['labels']))
+
+    first, last = np.searchsorted(index['terms'], [query, query + '\U0010ffff'])
+    owners, entities = graph_neighbours(index['term_indptr'], index['term_entities'], np.arange(first, last))
+    np.maximum.at(scores, entities, 1 + len(query) / index['term_lengths'][owners])
+
+    if (np.count_nonzero(scores) < limit):
+        grams = [index['grams'][gram] for gram in trigrams(query) if gram in index['grams']]
+        if (grams):
+            shared = np.bincount(np.concatenate(grams), minlength=len(index['terms']))
+            terms = np.flatnonzero(shared)
+            similarity = 2 * shared[terms] / (len(trigrams(query)) + index['term_grams'][terms])
+            terms = terms[similarity >= 0.3]
+            similarity = similarity[similarity >= 0.3]
+            owners, entities = graph_neighbours(index['term_indptr'], index['term_entities'], terms)
+            np.maximum.at(scores, entities, similarity[np.searchsorted(terms, owners)])
+
+    # Ranked like top_k would, without building a DataFrame of every match for the few that are kept
+    matches = np.flatnonzero(scores)
+    statistic = np.round(scores[matches], 3)
+    order = np.lexsort((index['labels'][matches], -statistic))[:limit]
+    return pd.DataFrame({'subject': index['labels'][matches[order]], 'statistic': statistic[order]})
+
+
+def search_index(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments, used to load the airports and airlines.
+            The index is built once per pair of input files and stored in CACHE_DIR like the parsed inputs (see load_cached_dataset), so
+            later runs load it instead of building it again unless --CACHE="no" or --REBUILD_CACHE="yes" is given.
 
         Returns
         -------
-            None
-            This function does not return anything.
+            dict
+            The search index of build_search_index.
     """
-    titles = []
-    data = []
-    for arg in range(1, len(sys.argv)):
-        argument = sys.argv[arg][2:]
-        split = argument.split("=")
-        titles.append(split[0])
-        data.append(split[1])
-
-    if (data[3] == "q1"):
-        question1(data)
-    elif (data[3] == "q2"):
-        question2(data)
-    elif (data[3] == "q3"):
-        question3(data)
-    elif (data[3] == "q4"):
-        question4(data)
-    else:
-        question5(data)
+    index_key = ('search_index', arguments['AIRPORTS'], arguments['AIRLINES'])
+    if (index_key in _derived_frames):
+        return _derived_frames[index_key]
 
+    if (arguments.get('CACHE', 'yes') == "no"):
+        _derived_frames[index_key] = build_search_index(arguments)
+        return _derived_frames[index_key]
 
-def question1(list_data):
+    cache_dir = arguments.get('CACHE_DIR', '.route_cache')
+    fingerprints = [file_fingerprint(arguments['AIRPORTS']), file_fingerprint(arguments['AIRLINES'])]
+    file_hash = hashlib.sha1(('search\0' + '\0'.join(path for path, _, _ in fingerprints)).encode()).hexdigest()
+    version_hash = hashlib.sha1((repr([fingerprint[1:] for fingerprint in fingerprints]) + '\0' + str(CACHE_FORMAT_VERSION)).encode()).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, file_hash + '.' + version_hash + '.pickle')
+
+    if (arguments.get('REBUILD_CACHE', 'no') != "yes" and os.path.exists(cache_file)):
+        with measure_phase('cache_read'):
+            _derived_frames[index_key] = pd.read_pickle(cache_file)
+        return _derived_frames[index_key]
+
+    index = build_search_index(arguments)
+    remove_stale_entries(cache_dir, file_hash, cache_file)
+    temporary_file = cache_file + '.' + str(os.getpid()) + '.tmp'
+    pd.to_pickle(index, temporary_file)
+    os.replace(temporary_file, cache_file)
+
+    _derived_frames[index_key] = index
+    return index
+
+
+def build_search_index(arguments):
     """Parameters
         ----------
-            list_data : list
-            
-            A list containing the arguments obtained from the command line. list_data contains the actual values of the arguments.
-       
+            arguments : dict
+
+            The dictionary of command line arguments, used to load the airports and airlines.
+            Every value of SEARCH_COLUMNS is indexed as a whole and word by word, lower cased, so "tor" finds Toronto as a city and "pearson"
+            finds "Lester B. Pearson International Airport".
+
         Returns
         -------
-            None
-            This function does not return anything, but it does create a csv file where output is stored.
+            dict
+            labels holds the label of every airport (see airport_labels) followed by every airline (see airline_labels). terms holds the
+            sorted distinct terms, and the airports and airlines of every term are term_entities[term_indptr[term]:term_indptr[term + 1]],
+            in the compressed sparse row form of route_graph. grams maps every trigram to the sorted terms containing it, term_grams
+            gives the number of distinct trigrams of every term and term_lengths its length.
     """
-    with open(list_data[0], 'r') as f:
-        airline_file = yaml.safe_load(f)
+    load_datasets(arguments, ('airports', 'airlines'))
+    entities = {'airports': airport_labels(arguments)['airport'], 'airlines': airline_labels(arguments)['airline']}
+    with measure_phase('search_index', sum(len(labels) for labels in entities.values())):
+        pairs = []
+        offset = 0
+        for key, labels in entities.items():
+            dataset_df = load_dataset(arguments, key)
+            for column in SEARCH_COLUMNS[key]:
+                values = dataset_df[column].astype(str).where(dataset_df[column].notna(), '').map(normalize_search_text)
+                values.index = np.arange(offset, offset + len(values))
+                words = values.str.split(r'\W+', regex=True).explode()
+                pairs.append(pd.DataFrame({'term': pd.concat([values, words]).to_numpy(object),
+                                           'entity': np.concatenate([values.index, words.index])}))
+            offset += len(labels)
 
-    airlines_df = pd.DataFrame.from_dict(airline_file['airlines'])
+        pairs_df = pd.concat(pairs, ignore_index=True)
+        pairs_df = pairs_df[pairs_df['term'].str.len() > 0].drop_duplicates().sort_values(['term', 'entity'])
+        codes, terms = pd.factorize(pairs_df['term'])
+        term_indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(terms)), out=term_indptr[1:])
 
-    with open(list_data[1], 'r') as f:
-        airport_file = yaml.safe_load(f)
+        grams = {}
+        term_grams = np.zeros(len(terms), dtype=np.int64)
+        for number, term in enumerate(terms):
+            term_trigrams = trigrams(term)
+            term_grams[number] = len(term_trigrams)
+            for gram in term_trigrams:
+                grams.setdefault(gram, []).append(number)
 
-    airports_df = pd.DataFrame.from_dict(airport_file['airports'])
+    return {
+        'labels': np.concatenate([labels.astype(str).to_numpy(object) for labels in entities.values()]),
+        'terms': np.asarray(terms, dtype=object),
+        'term_indptr': term_indptr,
+        'term_entities': pairs_df['entity'].to_numpy(np.int64),
+        'grams': {gram: np.array(numbers, dtype=np.int64) for gram, numbers in grams.items()},
+        'term_grams': term_grams,
+        'term_lengths': np.array([len(term) for term in terms], dtype=float),
+    }
 
-    with open(list_data[2], 'r') as f:
-        route_file = yaml.safe_load(f)
-    
-    routes_df = pd.DataFrame.from_dict(route_file['routes'])
 
-    airports_df = airports_df.loc[airports_df['airport_country'].str.contains('Canada')]
+def normalize_search_text(text):
+    """Parameters
+        ----------
+            text : str
+
+            A name, or what was typed to search for one.
 
-    merged_airline_id_df = pd.merge(airlines_df, routes_df, left_on='airline_id', right_on='route_airline_id')
+        Returns
+        -------
+            str
+            text lower cased (casefold) with its words separated by single spaces, so searches ignore case and spacing.
+    """
+    return ' '.join(text.casefold().split())
 
-    merged_airports_df = pd.merge(airports_df, merged_airline_id_df, left_on='airport_id', right_on='route_to_airport_id')
-    merged_airports_df['airline_name'] = merged_airports_df['airline_name'] + ' (' + merged_airports_df['airline_icao_unique_code'] + ')'
 
-    grouped_df = merged_airports_df.groupby('airline_name').size().reset_index(name='statistic').sort_values(['statistic', 'airline_name'], ascending=[False, True]).head(20)
-    grouped_df = grouped_df.rename(columns={'airline_name': 'subject'})
+def trigrams(text):
+    """Parameters
+        ----------
+            text : str
 
-    grouped_df.to_csv('q1.csv', index=False)
+            A normalized term (see normalize_search_text).
 
-    if (list_data[4] == "bar"):
-        create_bar(grouped_df, 'subject', 'statistic', 6, 6, 'Airlines', 'Number of Routes with Destination Country as Canada', 'Top Airlines with Greatest Number of Routes to Canada', 'q1.pdf')
-    else:
-        create_pie(grouped_df, 'subject', 'statistic', 6, 6, 'Top Airlines with Greatest Number of Routes to Canada', 'q1.pdf')
+        Returns
+        -------
+            set
+            The sequences of three characters of text padded with spaces, so its start and end count like any other trigram.
+    """
+    padded = '  ' + text + ' '
+    return {padded[position:position + 3] for position in range(len(padded) - 2)}
 
 
-def question2(list_data):
+def input_cache_file(arguments, file_name, key):
     """Parameters
         ----------
-            list_data : list
-            
-            A list containing the arguments obtained from the command line. list_data contains the actual values of the arguments.
-       
+            arguments : dict
+            file_name : str
+            key : str
+
+            arguments is the dictionary of command line arguments, file_name and key are the input file and top level list to load.
+            Cache entries are named <file hash>.<fingerprint hash>.<format>, so an entry left behind by an older version of the same file can
+            be found from its file hash. Parquet is used when pyarrow is installed, otherwise the DataFrame is pickled.
+
         Returns
         -------
-            None
-            This function does not return anything, but it does create a csv file where output is stored.
+            tuple
+            The file hash and the path of the cache entry of the current version of file_name in CACHE_DIR.
     """
-    with open(list_data[1], 'r') as f:
-        airport_file = yaml.safe_load(f)
+    cache_dir = arguments.get('CACHE_DIR', '.route_cache')
+    path, size, mtime = file_fingerprint(file_name)
+    file_hash = hashlib.sha1((path + '\0' + key).encode()).hexdigest()
+    version_hash = hashlib.sha1((str(size) + '\0' + str(mtime) + '\0' + str(CACHE_FORMAT_VERSION)).encode()).hexdigest()[:16]
+    cache_format = 'parquet' if importlib.util.find_spec('pyarrow') else 'pickle'
+
+    return file_hash, os.path.join(cache_dir, file_hash + '.' + version_hash + '.' + cache_format)
+
+
+def load_cached_dataset(arguments, file_name, key, processes=None):
+    """Parameters
+        ----------
+            arguments : dict
+            file_name : str
+            key : str
+            processes : concurrent.futures Executor
 
-    airports_df = pd.DataFrame.from_dict(airport_file['airports'])
+            arguments is the dictionary of command line arguments, file_name and key are the input file and top level list to load.
+            The cache entry is named by input_cache_file, an entry left behind by an older version of the same file is removed whenever a
+            new one is written. The file is parsed in processes when it is given.
 
-    with open(list_data[2], 'r') as f:
-        route_file = yaml.safe_load(f)
-    
-    routes_df = pd.DataFrame.from_dict(route_file['routes'])
+        Returns
+        -------
+            pandas Dataframe
+            The records stored under key in file_name, read from the cache when it holds an entry for the current version of the file.
+    """
+    cache_dir = arguments.get('CACHE_DIR', '.route_cache')
+    file_hash, cache_file = input_cache_file(arguments, file_name, key)
 
-    merged_airports_df = pd.merge(airports_df, routes_df, left_on='airport_id', right_on='route_to_airport_id')
-    merged_airports_df['airport_country'] = merged_airports_df['airport_country'].apply(str.strip)
+    if (arguments.get('REBUILD_CACHE', 'no') != "yes" and os.path.exists(cache_file)):
+        with measure_phase('cache_read'):
+            if (cache_file.endswith('.parquet')):
+                return pd.read_parquet(cache_file)
+            return pd.read_pickle(cache_file)
 
-    grouped_df = merged_airports_df.groupby('airport_country').size().reset_index(name='statistic').sort_values(['statistic', 'airport_country'], ascending=[True, True]).head(30)
-    grouped_df = grouped_df.rename(columns={'airport_country': 'subject'})
+    dataframe = parse_dataset_in(processes, file_name, key, LOAD_COLUMNS[key],
+                                 decompress_thread=arguments.get('DECOMPRESS_THREAD', 'no') == "yes")
 
-    grouped_df.to_csv('q2.csv', index=False)
+    remove_stale_entries(cache_dir, file_hash, cache_file)
 
-    if (list_data[4] == "bar"):
-        create_bar(grouped_df, 'subject', 'statistic', 6, 6, 'Least Popular Destination Countries', 'Number of Routes with this Country as Destination', 'Least Popular Destination Countries', 'q2.pdf')
+    # Write to a temporary name first so an interrupted run never leaves a truncated entry behind
+    temporary_file = cache_file + '.' + str(os.getpid()) + '.tmp'
+    if (cache_file.endswith('.parquet')):
+        dataframe.to_parquet(temporary_file, index=False)
     else:
-        create_pie(grouped_df, 'subject', 'statistic', 6, 6, 'Least Popular Destination Countries', 'q2.pdf')
+        dataframe.to_pickle(temporary_file)
+    os.replace(temporary_file, cache_file)
+
+    return dataframe
 
 
-def question3(list_data):
+def remove_stale_entries(cache_dir, file_hash, cache_file):
     """Parameters
         ----------
-            list_data : list
-            
-            A list containing the arguments obtained from the command line. list_data contains the actual values of the arguments.
-       
+            cache_dir : str
+            file_hash : str
+            cache_file : str
+
+            cache_dir is the cache directory, created if needed, file_hash the hash every entry of one input is named after and cache_file
+            the entry about to be written. Several runs may fill the cache at the same time, so the temporary files other runs are still
+            writing and cache_file, which another run may have published already, are kept, and an entry another run removed first is
+            not an error.
+
         Returns
         -------
             None
-            This function does not return anything, but it does create a csv file where output is stored.
+            This function does not return anything, but it does delete the entries of older versions of the input.
     """
-    with open(list_data[1], 'r') as f:
-        airport_file = yaml.safe_load(f)
+    os.makedirs(cache_dir, exist_ok=True)
+    for old_file in os.listdir(cache_dir):
+        if (old_file.startswith(file_hash + '.') and not old_file.endswith('.tmp') and old_file != os.path.basename(cache_file)):
+            try:
+                os.remove(os.path.join(cache_dir, old_file))
+            except FileNotFoundError:
+                pass
 
-    airports_df = pd.DataFrame.from_dict(airport_file['airports'])
 
-    with open(list_data[2], 'r') as f:
-        route_file = yaml.safe_load(f)
-    
-    routes_df = pd.DataFrame.from_dict(route_file['routes'])
+class QuerySpec(NamedTuple):
+    """A question about the routes, answered by run_query"""
+    group_by: str  # airline, country, airport or city to count routes, route to list every route, component for route networks
+    metric: str = 'routes'  # routes (number of routes), altitude_difference (only with group_by route) or a GRAPH_METRICS metric
+    direction: str = 'destination'  # end of the route that country and the airport attributes refer to: destination, origin or both
+    country: str = ''  # only routes whose airport at direction is in this country (exact name), every route when empty
+    order: str = 'desc'  # desc puts the largest statistic first, asc the smallest
+    limit: int = 10  # number of rows in the answer
+    source: str = ''  # ICAO code of the airport the stops metric starts from
+    max_stops: int = 1  # most stops of the stops metric, 0 for direct routes only
 
-    merged_airports_df = pd.merge(airports_df, routes_df, left_on='airport_id', right_on='route_to_airport_id')
-    merged_airports_df['airport_name'] = merged_airports_df['airport_name'].apply(str.strip)
-    merged_airports_df['airport_name'] = merged_airports_df['airport_name'] + ' (' + merged_airports_df['airport_icao_unique_code'] + '),' + ' ' + merged_airports_df['airport_city'] + ', ' + merged_airports_df['airport_country']
 
-    grouped_df = merged_airports_df.groupby('airport_name').size().reset_index(name='statistic').sort_values(['statistic', 'airport_name'], ascending=[False, True]).head(10)
-    grouped_df = grouped_df.rename(columns={'airport_name': 'subject'})
+def parse_query(text):
+    """Parameters
+        ----------
+            text : str
 
-    grouped_df.to_csv('q3.csv', index=False)
+            A query written as semicolon separated field=value pairs of QuerySpec, for example "group_by=airline;country=Mexico;limit=20".
 
-    if (list_data[4] == "bar"):
-        create_bar(grouped_df, 'subject', 'statistic', 6, 6, 'Top Destination Airports', 'Number of Routes with Airport Destination', 'Top 10 Destination Airports', 'q3.pdf')
-    else:
-        create_pie(grouped_df, 'subject', 'statistic', 7, 4, 'Top 10 Destination Airports', 'q3.pdf')
+        Returns
+        -------
+            QuerySpec
+            The query described by text, with the defaults of QuerySpec for the fields it leaves out.
+    """
+    fields = {}
+    for pair in text.split(';'):
+        if (pair.strip()):
+            field, _, value = pair.partition('=')
+            fields[field.strip()] = value.strip()
 
+    return make_query(fields)
 
-def question4(list_data):
+
+def make_query(fields):
     """Parameters
         ----------
-            list_data : list
-            
-            A list containing the arguments obtained from the command line. list_data contains the actual values of the arguments.
-       
+            fields : dict
+
+            The fields of a query as strings, keyed by QuerySpec field name.
+
         Returns
         -------
-            None
-            This function does not return anything, but it does create a csv file where output is stored.
+            QuerySpec
+            The query, after checking that every field has a supported value. A ValueError is raised otherwise.
     """
-    with open(list_data[1], 'r') as f:
-        airport_file = yaml.safe_load(f)
+    unknown = set(fields) - set(QuerySpec._fields)
+    if (unknown):
+        raise ValueError('Unknown query fields: ' + ', '.join(sorted(unknown)))
+    for field in ('limit', 'max_stops'):
+        if (field in fields):
+            fields = dict(fields, **{field: int(fields[field])})
 
-    airports_df = pd.DataFrame.from_dict(airport_file['airports'])
+    spec = QuerySpec(**fields)
+    if (spec.group_by not in GROUP_BY_LABELS):
+        raise ValueError('group_by must be one of ' + ', '.join(GROUP_BY_LABELS))
+    if (spec.metric not in METRIC_LABELS):
+        raise ValueError('metric must be one of ' + ', '.join(METRIC_LABELS))
+    if (spec.metric == 'altitude_difference' and spec.group_by != 'route'):
+        raise ValueError('altitude_difference can only be grouped by route')
+    if (spec.metric in GRAPH_METRICS and spec.group_by != GRAPH_METRICS[spec.metric]):
+        raise ValueError(spec.metric + ' can only be grouped by ' + GRAPH_METRICS[spec.metric])
+    if (spec.group_by == 'component' and spec.metric != 'airports'):
+        raise ValueError('component can only be measured in airports')
+    if ((spec.metric == 'stops') != bool(spec.source)):
+        raise ValueError('source must be given with the stops metric, and only with it')
+    if (spec.max_stops < 0):
+        raise ValueError('max_stops cannot be negative')
+    if (spec.direction not in ('destination', 'origin', 'both')):
+        raise ValueError('direction must be destination, origin or both')
+    if (spec.direction == 'both' and spec.group_by in ('country', 'airport', 'city') and spec.metric not in GRAPH_METRICS):
+        raise ValueError('direction both can only be used with group_by airline or route')
+    if (spec.order not in ('asc', 'desc')):
+        raise ValueError('order must be asc or desc')
+    if (spec.limit < 1):
+        raise ValueError('limit must be at least 1')
 
-    with open(list_data[2], 'r') as f:
-        route_file = yaml.safe_load(f)
-    
-    routes_df = pd.DataFrame.from_dict(route_file['routes'])
+    return spec
 
-    merged_airports_df = pd.merge(airports_df, routes_df, left_on='airport_id', right_on='route_to_airport_id')
-    merged_airports_df['airport_city'] = merged_airports_df['airport_city'].apply(str.strip)
-    merged_airports_df['airport_city'] = merged_airports_df['airport_city'] + ', ' + merged_airports_df['airport_country']
 
-    grouped_df = merged_airports_df.groupby('airport_city').size().reset_index(name='statistic').sort_values(['statistic', 'airport_city'], ascending=[False, True]).head(15)
-    grouped_df = grouped_df.rename(columns={'airport_city': 'subject'})
+def limit_query(arguments, spec):
+    """Parameters
+        ----------
+            arguments : dict
+            spec : QuerySpec
 
-    grouped_df.to_csv('q4.csv', index=False)
+            arguments is the dictionary of command line arguments and spec is a query.
 
-    if (list_data[4] == "bar"):
-        create_bar(grouped_df, 'subject', 'statistic', 6, 6, 'Top Destination Cities', 'Number of Routes with City Destination', 'Top 15 Destination Cities', 'q4.pdf')
-    else:
-        create_pie(grouped_df, 'subject', 'statistic', 6, 6, 'Top 15 Destination Cities', 'q4.pdf')
+        Returns
+        -------
+            QuerySpec
+            spec with its limit replaced by --TOP_N when it is given. A ValueError is raised when TOP_N is less than 1, like make_query
+            raises it for a limit.
+    """
+    if ('TOP_N' in arguments):
+        if (int(arguments['TOP_N']) < 1):
+            raise ValueError('--TOP_N must be at least 1')
+        return spec._replace(limit=int(arguments['TOP_N']))
+    return spec
 
 
-def question5(list_data):
+def describe_query(spec):
     """Parameters
         ----------
-            list_data : list
-            
-            A list containing the arguments obtained from the command line. list_data contains the actual values of the arguments.
-       
+            spec : QuerySpec
+
+            A query.
+
         Returns
         -------
-            None
-            This function does not return anything, but it does create a csv file where output is stored.
-    """
-    with open(list_data[1], 'r') as f:
-        airport_file = yaml.safe_load(f)
-
-    airports_df = pd.DataFrame.from_dict(airport_file['airports'])
-
-    with open(list_data[2], 'r') as f:
-        route_file = yaml.safe_load(f)
-    
-    routes_df = pd.DataFrame.from_dict(route_file['routes'])
-
-    airports_df = airports_df.loc[airports_df['airport_country'].str.contains('Canada')]
-    
-    merged_airports_df = pd.merge(airports_df, routes_df, left_on='airport_id', right_on='route_from_aiport_id', how='inner')
-
-    merged_airports_df = pd.merge(merged_airports_df, airports_df, left_on='route_to_airport_id', right_on='airport_id', how='inner')
-    merged_airports_df = merged_airports_df.rename(columns={'airport_altitude': 'airport_altitude_y'})
-    merged_airports_df.drop(['airport_id_x', 'airport_name_x', 'airport_city_x', 'airport_country_x', 'airport_id_y', 'airport_name_y', 'airport_city_y', 'airport_country_y', 'route_airline_id', 'route_from_aiport_id', 'route_to_airport_id'], inplace=True, axis=1)
-    
-    merged_airports_df['airport_icao_unique_code'] = merged_airports_df['airport_icao_unique_code_x'] + '-' + merged_airports_df['airport_icao_unique_code_y']
-    merged_airports_df['airport_altitude'] = (merged_airports_df['airport_altitude_x'].astype(float) - merged_airports_df['airport_altitude_y'].astype(float)).abs()
-    merged_airports_df.drop(['airport_icao_unique_code_x', 'airport_altitude_x', 'airport_icao_unique_code_y', 'airport_altitude_y'], inplace=True, axis=1)
-    
-    grouped_df = merged_airports_df.sort_values(['airport_altitude', 'airport_icao_unique_code'], ascending=[False, True]).head(10)
-    grouped_df = grouped_df.rename(columns={'airport_icao_unique_code': 'subject'})
-    grouped_df = grouped_df.rename(columns={'airport_altitude': 'statistic'})
-
-    grouped_df.to_csv('q5.csv', index=False)
-
-    if (list_data[4] == "bar"):
-        create_bar(grouped_df, 'subject', 'statistic', 7, 6, 'Unique Route Codes', 'Difference in Destination and Origin Altitudes', 'Unique Top 10 Canadian Routes with Greatest Difference in Altitude', 'q5.pdf')
-    else:
-        create_pie(grouped_df, 'subject', 'statistic', 6, 6, 'Unique Top 10 Canadian Routes with Greatest Difference in Altitude', 'q5.pdf')
+            str
+            A title for the answer to spec, for example "Top 20 Airlines by Number of Routes (destination in Mexico)".
+    """
+    title = ('Top ' if spec.order == 'desc' else 'Bottom ') + str(spec.limit) + ' ' + GROUP_BY_LABELS[spec.group_by] + ' by ' + METRIC_LABELS[spec.metric]
+    if (spec.metric in GRAPH_METRICS and spec.country):
+        title += ' (within ' + spec.country + ')'
+    elif (spec.country):
+        title += ' (' + spec.direction + ' in ' + spec.country + ')'
+    if (spec.source):
+        title += (' to ' if spec.direction == 'destination' else ' from ') + spec.source
+
+    return title
+
+
+def plan_query(spec):
+    """Parameters
+        ----------
+            spec : QuerySpec
+
+            A query.
+
+        Returns
+        -------
+            tuple
+            The route ends (airline_id, origin_id, destination_id) spec needs, which is also the route index it is answered from. Queries
+            that group and filter by the destination only need the small per destination counts, for example.
+    """
+    ends = set()
+    if (spec.group_by == 'airline'):
+        ends.add('airline_id')
+    if (spec.group_by == 'route' or spec.direction == 'both'):
+        ends.update(('origin_id', 'destination_id'))
+    elif (spec.group_by != 'airline' or spec.country):
+        ends.add(spec.direction + '_id')
+
+    return tuple(column for column in ROUTE_COLUMNS if column in ends)
+
+
+def query_inputs(spec):
+    """Parameters
+        ----------
+            spec : QuerySpec
+
+            A query.
+
+        Returns
+        -------
+            tuple
+            The datasets spec reads, a change to any of them invalidates its cached answers.
+    """
+    if (spec.group_by == 'airline'):
+        return ('airlines', 'airports', 'routes')
+    return ('airports', 'routes')
+
+
+def run_query(arguments, spec):
+    """Parameters
+        ----------
+            arguments : dict
+            spec : QuerySpec
+
+            arguments is the dictionary of command line arguments and spec is the query to answer.
+            The input files spec reads are loaded together by load_datasets. The query is answered from the route index chosen by
+            plan_query: each route end it needs is joined once to the labelled airports (only those in spec.country when the end is
+            filtered by country), the routes are summed per label and the best spec.limit labels are kept. Queries with the
+            altitude_difference metric are answered by run_altitude_query and queries with a GRAPH_METRICS metric by run_graph_query
+            instead.
+
+        Returns
+        -------
+            pandas Dataframe
+            The subject and statistic columns answering the query.
+    """
+    # The routes are not loaded when they are counted in ROUTE_COUNTS or streamed
+    streamed = 'ROUTE_COUNTS' in arguments or arguments.get('OUT_OF_CORE', 'no') == "yes"
+    load_datasets(arguments, [key for key in query_inputs(spec) if key != 'routes' or not streamed])
+
+    if (spec.metric == 'altitude_difference'):
+        return run_altitude_query(arguments, spec)
+    if (spec.metric in GRAPH_METRICS):
+        return run_graph_query(arguments, spec)
+
+    ends = plan_query(spec)
+    merged_df = route_index(arguments, ends)
+    labels_df = airport_labels(arguments)
+    airline_labels_df = airline_labels(arguments) if spec.group_by == 'airline' else None
+    if (spec.country):
+        country_labels_df = labels_df.iloc[np.sort(country_airports(arguments, spec.country))]
+
+    with measure_phase('merge') as phase:
+        for end in ('origin', 'destination'):
+            if (end + '_id' in ends):
+                filtered = spec.country and spec.direction in (end, 'both')
+                end_labels_df = (country_labels_df if filtered else labels_df).add_prefix(end + '_')
+                merged_df = pd.merge(merged_df, end_labels_df, left_on=end + '_id', right_on=end + '_airport_id')
+
+        if (spec.group_by == 'airline'):
+            merged_df = pd.merge(airline_labels_df, merged_df, on='airline_id')
+            merged_df['subject'] = merged_df['airline']
+        elif (spec.group_by == 'route'):
+            merged_df['subject'] = merged_df['origin_airport_icao_unique_code'] + '-' + merged_df['destination_airport_icao_unique_code']
+        else:
+            merged_df['subject'] = merged_df[spec.direction + '_' + spec.group_by]
+        phase['rows'] = len(merged_df)
+
+    with measure_phase('groupby', len(merged_df)):
+        grouped_df = merged_df.groupby('subject')['routes'].sum().reset_index(name='statistic')
+
+    with measure_phase('top_k', len(grouped_df)):
+        return top_k(grouped_df, 'statistic', 'subject', spec.order == 'asc', spec.limit).reset_index(drop=True)
+
+
+def run_altitude_query(arguments, spec):
+    """Parameters
+        ----------
+            arguments : dict
+            spec : QuerySpec
+
+            arguments is the dictionary of command line arguments and spec is a query with the altitude_difference metric.
+            The airports of every route are looked up once (see route_airport_positions) and the routes are ranked by rank_altitude_routes.
+            With OUT_OF_CORE the routes are streamed instead: every chunk is ranked on its own and only the best spec.limit routes seen so
+            far are kept, which gives the same answer since the routes are ranked by altitude difference and then by subject.
+
+        Returns
+        -------
+            pandas Dataframe
+            The subject (origin and destination ICAO codes) and statistic (absolute altitude difference) columns answering the query.
+    """
+    if ('ROUTE_COUNTS' in arguments):
+        raise ValueError('altitude_difference queries need every route, they cannot be answered from --ROUTE_COUNTS')
+
+    labels_df = airport_labels(arguments)
+    # Position -1 marks an unknown airport, it picks the extra last element: NaN altitude, outside of every country
+    altitudes = np.append(pd.to_numeric(labels_df['airport_altitude'], errors='coerce').to_numpy(dtype=float), np.nan)
+    in_country = None
+    if (spec.country):
+        in_country = np.zeros(len(labels_df) + 1, dtype=bool)
+        in_country[country_airports(arguments, spec.country)] = True
+
+    if (arguments.get('OUT_OF_CORE', 'no') != "yes"):
+        origin_positions, destination_positions = route_airport_positions(arguments)
+        return rank_altitude_routes(labels_df, altitudes, in_country, origin_positions, destination_positions, spec).reset_index(drop=True)
+
+    grouped_df = None
+    with measure_phase('stream:routes') as phase:
+        phase['rows'] = 0
+        for chunk_df in stream_dataset(arguments, 'routes'):
+            origin_positions, destination_positions = locate_route_airports(labels_df['airport_id'], chunk_df)
+            chunk_grouped_df = rank_altitude_routes(labels_df, altitudes, in_country, origin_positions, destination_positions, spec)
+            if (grouped_df is None):
+                grouped_df = chunk_grouped_df
+            else:
+                grouped_df = top_k(pd.concat([grouped_df, chunk_grouped_df], ignore_index=True), 'statistic', 'subject',
+                                   spec.order == 'asc', spec.limit)
+            phase['rows'] += len(chunk_df)
+
+    return grouped_df.reset_index(drop=True)
+
+
+def rank_altitude_routes(labels_df, altitudes, in_country, origin_positions, destination_positions, spec):
+    """Parameters
+        ----------
+            labels_df : pandas Dataframe
+            altitudes : numpy array
+            in_country : numpy array
+            origin_positions : numpy array
+            destination_positions : numpy array
+            spec : QuerySpec
+
+            labels_df is airport_labels, altitudes the altitude of every airport of labels_df followed by NaN and in_country whether every
+            airport of labels_df is in spec.country followed by False (None when spec has no country). origin_positions and
+            destination_positions are the airport_labels rows of the routes to rank (see locate_route_airports).
+            The altitude difference of all the routes is computed with numpy fancy indexing into altitudes, the routes outside spec.country
+            are masked out the same way and only the routes that can be in the answer get a label. Every route is listed on its own, so a
+            route flown by several airlines appears once per airline.
+
+        Returns
+        -------
+            pandas Dataframe
+            The best spec.limit routes, with their subject (origin and destination ICAO codes) and statistic (absolute altitude difference).
+    """
+    with measure_phase('altitude_difference', len(origin_positions)):
+        selected = (origin_positions >= 0) & (destination_positions >= 0)
+        if (in_country is not None):
+            if (spec.direction in ('origin', 'both')):
+                selected &= in_country[origin_positions]
+            if (spec.direction in ('destination', 'both')):
+                selected &= in_country[destination_positions]
+
+        origin_positions = origin_positions[selected]
+        destination_positions = destination_positions[selected]
+        differences = np.abs(altitudes[origin_positions] - altitudes[destination_positions])
+
+    with measure_phase('top_k', len(differences)):
+        keys = differences if spec.order == 'asc' else -differences
+        known = ~np.isnan(keys)
+        if (known.sum() > spec.limit):
+            threshold = np.partition(keys[known], spec.limit - 1)[spec.limit - 1]
+            candidates = np.flatnonzero(keys <= threshold)
+        else:
+            candidates = np.arange(len(keys))
+
+        icao_codes = labels_df['airport_icao_unique_code'].astype(str).to_numpy()
+        grouped_df = pd.DataFrame({
+            'subject': pd.Series(icao_codes[origin_positions[candidates]]) + '-' + pd.Series(icao_codes[destination_positions[candidates]]),
+            'statistic': differences[candidates],
+        })
+
+        return top_k(grouped_df, 'statistic', 'subject', spec.order == 'asc', spec.limit)
+
+
+def run_graph_query(arguments, spec):
+    """Parameters
+        ----------
+            arguments : dict
+            spec : QuerySpec
+
+            arguments is the dictionary of command line arguments and spec is a query with a GRAPH_METRICS metric. The network has one node
+            per airport and one edge per pair of airports linked by a route (see route_graph), limited to the routes between two airports
+            of spec.country when it is given. spec.direction orients it: origin follows the routes, destination goes against them and both
+            ignores their direction.
+            degree counts the airports each airport is linked to (routes leaving it for origin, arriving for destination), betweenness
+            counts the shortest paths between two other airports that go through it (Brandes' algorithm, one breadth first search per
+            airport), stops gives the fewest stops needed to reach every airport at most spec.max_stops stops away from spec.source, and
+            airports gives the size of every connected network, ignoring the direction of the routes, named after its best linked airport.
+
+        Returns
+        -------
+            pandas Dataframe
+            The subject (airport or network) and statistic columns answering the query. Airports without any route in the network are
+            left out.
+    """
+    labels_df = airport_labels(arguments)
+    indptr, indices = route_graph(arguments, spec.direction, spec.country)
+    undirected_indptr, undirected_indices = route_graph(arguments, 'both', spec.country)
+    linked_airports = np.diff(undirected_indptr)
+    nodes = np.flatnonzero(linked_airports)
+
+    with measure_phase('graph:' + spec.metric, len(indices)):
+        if (spec.metric == 'degree'):
+            statistic = np.diff(indptr)[nodes]
+        elif (spec.metric == 'betweenness'):
+            centrality = graph_betweenness(indptr, indices)
+            # Every undirected path is found once from each of its ends, and rounding lets the summation error not break ties
+            statistic = np.round(centrality / 2 if spec.direction == 'both' else centrality, 6)[nodes]
+        elif (spec.metric == 'stops'):
+            sources = np.flatnonzero(labels_df['airport_icao_unique_code'].astype(str).to_numpy() == spec.source.strip())
+            flights = graph_distances(indptr, indices, sources, spec.max_stops + 1)
+            nodes = np.flatnonzero(flights > 0)
+            statistic = flights[nodes] - 1
+        else:
+            components = graph_components(undirected_indptr, undirected_indices)
+            networks_df = pd.DataFrame({'component': components[nodes], 'linked_airports': linked_airports[nodes], 'node': nodes})
+            networks_df = networks_df.sort_values(['component', 'linked_airports', 'node'], ascending=[True, False, True])
+            hubs_df = networks_df.drop_duplicates('component')
+            statistic = networks_df.groupby('component', sort=True).size().loc[hubs_df['component']].to_numpy()
+            nodes = hubs_df['node'].to_numpy()
+
+    grouped_df = pd.DataFrame({'subject': labels_df['airport'].to_numpy()[nodes], 'statistic': statistic})
+    with measure_phase('top_k', len(grouped_df)):
+        return top_k(grouped_df, 'statistic', 'subject', spec.order == 'asc', spec.limit).reset_index(drop=True)
+
+
+def route_graph(arguments, direction, country=''):
+    """Parameters
+        ----------
+            arguments : dict
+            direction : str
+            country : str
+
+            arguments is the dictionary of command line arguments, used to load the airports and routes. direction is origin to follow the
+            routes, destination to go against them and both to link the airports of a route both ways. When country is given only the
+            routes between two airports of that country are kept.
+            The network is built from the route index by origin and destination, so it is built once per input files, direction and
+            country, without going through the routes again.
+
+        Returns
+        -------
+            tuple
+            The network in compressed sparse row form: indices[indptr[row]:indptr[row + 1]] are the airport_labels rows linked from the
+            airport at row (sorted, without repetitions or routes from an airport to itself).
+    """
+    graph_key = ('route_graph', arguments['AIRPORTS'], arguments['ROUTES'], direction, country)
+    if (graph_key not in _derived_frames):
+        labels_df = airport_labels(arguments)
+        pairs_df = route_index(arguments, ('origin_id', 'destination_id'))
+        with measure_phase('route_graph', len(pairs_df)):
+            airports = len(labels_df)
+            origins, destinations = locate_route_airports(labels_df['airport_id'], pairs_df.rename(columns=ROUTE_COLUMNS))
+            selected = (origins >= 0) & (destinations >= 0) & (origins != destinations)
+            if (country):
+                in_country = np.zeros(airports + 1, dtype=bool)
+                in_country[country_airports(arguments, country)] = True
+                selected &= in_country[origins] & in_country[destinations]
+            origins = origins[selected]
+            destinations = destinations[selected]
+
+            if (direction == 'destination'):
+                origins, destinations = destinations, origins
+            elif (direction == 'both'):
+                origins, destinations = np.concatenate([origins, destinations]), np.concatenate([destinations, origins])
+            # Sorted by origin and then destination, so the destinations are the CSR indices
+            edges = np.unique(origins * airports + destinations)
+            origins, destinations = np.divmod(edges, airports)
+            indptr = np.zeros(airports + 1, dtype=np.int64)
+            np.cumsum(np.bincount(origins, minlength=airports), out=indptr[1:])
+            _derived_frames[graph_key] = (indptr, destinations)
+
+    return _derived_frames[graph_key]
+
+
+def graph_neighbours(indptr, indices, nodes):
+    """Parameters
+        ----------
+            indptr : numpy array
+            indices : numpy array
+            nodes : numpy array
+
+            A network in compressed sparse row form (see route_graph) and some of its nodes.
+
+        Returns
+        -------
+            tuple
+            Two arrays with one element per edge leaving nodes: the node it leaves and the node it reaches. The edges are gathered with one
+            vectorized index computation instead of a loop over the nodes.
+    """
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    return np.repeat(nodes, counts), indices[positions]
+
+
+def graph_distances(indptr, indices, sources, max_depth):
+    """Parameters
+        ----------
+            indptr : numpy array
+            indices : numpy array
+            sources : numpy array
+            max_depth : int
+
+            A network in compressed sparse row form (see route_graph), the nodes the search starts from and the most edges it follows.
+            The breadth first search expands a whole level of nodes at a time with graph_neighbours.
+
+        Returns
+        -------
+            numpy array
+            The fewest edges needed to reach every node from sources, 0 for sources and -1 for the nodes not reached in max_depth edges.
+    """
+    distances = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    distances[sources] = 0
+    frontier = np.asarray(sources, dtype=np.int64)
+    for depth in range(1, max_depth + 1):
+        _, reached = graph_neighbours(indptr, indices, frontier)
+        frontier = np.unique(reached[distances[reached] < 0])
+        if (len(frontier) == 0):
+            break
+        distances[frontier] = depth
+
+    return distances
+
+
+def graph_betweenness(indptr, indices):
+    """Parameters
+        ----------
+            indptr : numpy array
+            indices : numpy array
+
+            A network in compressed sparse row form (see route_graph).
+            Brandes' algorithm runs one breadth first search per node with edges, counting the shortest paths to every node level by level,
+            and then sends the share of the paths through every node back up the levels. Every level is handled with whole array
+            operations, so the cost is one pass over the edges per node in numpy rather than in Python.
+
+        Returns
+        -------
+            numpy array
+            The betweenness of every node: the sum over all pairs of other nodes of the share of their shortest paths that go through it.
+    """
+    nodes = len(indptr) - 1
+    centrality = np.zeros(nodes)
+    for source in np.flatnonzero(np.diff(indptr)):
+        distances = np.full(nodes, -1, dtype=np.int64)
+        distances[source] = 0
+        paths = np.zeros(nodes)
+        paths[source] = 1
+        frontier = np.array([source])
+        levels = []
+        while (len(frontier) > 0):
+            parents, children = graph_neighbours(indptr, indices, frontier)
+            next_frontier = np.unique(children[distances[children] < 0])
+            distances[next_frontier] = len(levels) + 1
+            shortest = distances[children] == distances[parents] + 1
+            parents = parents[shortest]
+            children = children[shortest]
+            paths += np.bincount(children, weights=paths[parents], minlength=nodes)
+            levels.append((parents, children))
+            frontier = next_frontier
+
+        dependencies = np.zeros(nodes)
+        for parents, children in reversed(levels):
+            dependencies += np.bincount(parents, weights=paths[parents] / paths[children] * (1 + dependencies[children]), minlength=nodes)
+        dependencies[source] = 0
+        centrality += dependencies
+
+    return centrality
+
+
+def graph_components(indptr, indices):
+    """Parameters
+        ----------
+            indptr : numpy array
+            indices : numpy array
+
+            A network in compressed sparse row form whose edges go both ways (see route_graph).
+            Every node starts in its own component and repeatedly takes the smallest component of its neighbours, with pointer jumping so
+            the number of rounds grows with the logarithm of the diameter of the network rather than with the diameter.
+
+        Returns
+        -------
+            numpy array
+            The component of every node, numbered by its smallest node.
+    """
+    origins = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    components = np.arange(len(indptr) - 1)
+    while True:
+        merged = components.copy()
+        np.minimum.at(merged, origins, components[indices])
+        merged = merged[merged]
+        if (np.array_equal(merged, components)):
+            return components
+        components = merged
+
+
+def top_k(dataframe, statistic, subject, ascending, n):
+    """Parameters
+        ----------
+            dataframe : pandas Dataframe
+            statistic : str
+            subject : str
+            ascending : bool
+            n : int
+
+            dataframe holds the rows to rank, statistic is the column they are ranked by (smallest first when ascending is True, largest first
+            otherwise) and subject the column used to break ties, in alphabetical order. n is the number of rows to keep.
+            np.partition finds the value of the n-th row without sorting, so only the rows at least as good as it (ties included) are sorted.
+
+        Returns
+        -------
+            pandas Dataframe
+            The first n rows of dataframe in the same order as sort_values([statistic, subject]).head(n) would give.
+    """
+    if (n < len(dataframe)):
+        values = dataframe[statistic].to_numpy(dtype=float)
+        keys = values if ascending else -values
+        threshold = np.partition(keys, n - 1)[n - 1]
+        if (not np.isnan(threshold)):
+            dataframe = dataframe.loc[keys <= threshold]
+
+    return dataframe.sort_values([statistic, subject], ascending=[ascending, True]).head(n)
 
 
 def create_bar(dataframe, subject, statistic, figsize_x, figsize_y, xlabel, ylabel, title, pdf):
@@ -270,14 +2785,18 @@ def create_bar(dataframe, subject, statistic, figsize_x, figsize_y, xlabel, ylab
             None
             This function does not return anything, but it does create a pdf file where output is stored.
     """
-    bar_graph = dataframe.plot(kind='bar', x=subject, y=statistic, rot=90, fontsize=5, legend=False, figsize=(figsize_x, figsize_y))
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(figsize_x, figsize_y))
+    bar_graph = dataframe.plot(kind='bar', x=subject, y=statistic, rot=90, fontsize=5, legend=False, ax=figure.subplots())
 
     bar_graph.set_xlabel(xlabel, fontsize=7)
     bar_graph.set_ylabel(ylabel, fontsize=7)
     bar_graph.set_title(title)
 
-    plt.tight_layout()
-    plt.savefig(pdf)
+    figure.tight_layout()
+    with measure_phase('savefig'):
+        figure.savefig(pdf, format='pdf')
 
 def create_pie(dataframe, xlabel, ylabel, figsize_x, figsize_y, title, pdf):
     """Parameters
@@ -298,13 +2817,239 @@ def create_pie(dataframe, xlabel, ylabel, figsize_x, figsize_y, title, pdf):
             None
             This function does not return anything, but it does create a pdf file where output is stored.
     """
-    pie_chart = dataframe.plot(kind='pie', y=ylabel, labels=dataframe[xlabel], legend=False, fontsize=5, autopct='%1.1f%%', figsize=(figsize_x, figsize_y))
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(figsize_x, figsize_y))
+    pie_chart = dataframe.plot(kind='pie', y=ylabel, labels=dataframe[xlabel], legend=False, fontsize=5, autopct='%1.1f%%', ax=figure.subplots())
 
     pie_chart.set_ylabel(ylabel, fontsize=7)
     pie_chart.set_title(title)
 
-    plt.tight_layout()
-    plt.savefig(pdf)
+    figure.tight_layout()
+    with measure_phase('savefig'):
+        figure.savefig(pdf, format='pdf')
+
+
+class ChartRenderer:
+    """Draws charts with draw_chart in a pool of worker processes, so queries keep running while their charts are rendered"""
+
+    def __init__(self, workers: int) -> None:
+        """
+        ChartRenderer constructor creates an instance of ChartRenderer when the class is called
+        Parameters
+        ----------
+            self: ChartRenderer (refers to the instance of the class being operated on)
+            workers: int (number of worker processes, charts are drawn in the calling process when it is 1 or less)
+
+        Returns
+        -------
+            None
+        """
+        self.workers: int = workers
+        self.__pool = None  # concurrent.futures.ProcessPoolExecutor, started by the first chart submitted
+        self.__pending: list = []
+
+    def submit(self, grouped_df, question: str, spec, graph_type: str, pdf: str, copy_name: str = None) -> None:
+        """
+        submit method queues the chart of one answer, the worker processes are only started by the first chart
+        Parameters
+        ----------
+            self: ChartRenderer (refers to the instance of the class being operated on)
+            grouped_df, question, spec, graph_type, pdf, copy_name: the arguments of draw_chart
+
+        Returns
+        -------
+            None
+        """
+        if (self.workers <= 1):
+            draw_chart(grouped_df, question, spec, graph_type, pdf, copy_name)
+            return
+
+        if (self.__pool is None):
+            # Imported here so that runs drawing their charts in this process never pay for importing the worker pool
+            import concurrent.futures
+
+            self.__pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        self.__pending.append(self.__pool.submit(draw_chart, grouped_df, question, spec, graph_type, pdf, copy_name))
+
+    def close(self) -> None:
+        """
+        close method waits for every queued chart and stops the worker processes, raising the first error of a chart if any failed
+        Parameters
+        ----------
+            self: ChartRenderer (refers to the instance of the class being operated on)
+
+        Returns
+        -------
+            None
+        """
+        try:
+            for future in self.__pending:
+                future.result()
+        finally:
+            self.__pending = []
+            if (self.__pool is not None):
+                self.__pool.shutdown()
+                self.__pool = None
+
+    def __enter__(self) -> 'ChartRenderer':
+        return self
+
+    def __exit__(self, *exception) -> None:
+        self.close()
+
+
+def serve(arguments):
+    """Parameters
+        ----------
+            arguments : dict
+
+            The dictionary of command line arguments. SERVE gives the [host:]port to listen on (host defaults to localhost), for example
+            --SERVE="8265". The input files are loaded once before the server starts and stay in memory between requests.
+
+        Returns
+        -------
+            None
+            This function does not return, it answers requests until it is interrupted.
+    """
+    # Imported here so that runs without SERVE never pay for importing the HTTP server
+    import http.server
+    import urllib.parse
+
+    host, _, port = arguments['SERVE'].rpartition(':')
+    # The routes are not loaded when they are counted in ROUTE_COUNTS or streamed, like in run_query
+    streamed = 'ROUTE_COUNTS' in arguments or arguments.get('OUT_OF_CORE', 'no') == "yes"
+    load_datasets(arguments, [key for key in ('airlines', 'airports', 'routes') if key != 'routes' or not streamed])
+
+    class QueryHandler(http.server.BaseHTTPRequestHandler):
+        """Answers GET /<question> or GET /query?<QuerySpec fields> with the CSV of the answer, or with its chart as a PDF when
+        ?graph=bar or ?graph=pie is given, and GET /search?q=<text>&limit=<n> with the CSV of search_names"""
+        arguments = {}  # command line arguments of the server, shared by every request
+
+        def do_GET(self) -> None:
+            """
+            do_GET method answers one question using the DataFrames kept in memory, reloading any input file that changed since it was
+            loaded
+            Parameters
+            ----------
+                self: QueryHandler (refers to the instance of the class being operated on)
+
+            Returns
+            -------
+                None
+            """
+            url = urllib.parse.urlparse(self.path)
+            question = url.path.strip('/')
+            fields = dict(urllib.parse.parse_qsl(url.query))
+            graph_type = fields.pop('graph', '')
+
+            if (question == 'search'):
+                if (forget_changed_datasets()):
+                    self.log_message('input files changed, reloading')
+                try:
+                    body = search_names(self.arguments, fields.get('q', ''), int(fields.get('limit', 10))).to_csv(index=False).encode()
+                except ValueError as error:
+                    self.send_error(400, str(error))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/csv')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            elif (question == 'query'):
+                try:
+                    spec = make_query(fields)
+                except (TypeError, ValueError) as error:
+                    self.send_error(400, str(error))
+                    return
+            elif (question in QUESTIONS):
+                spec = limit_query(self.arguments, QUESTIONS[question])
+            else:
+                self.send_error(404, 'Unknown question, expected query, search or one of ' + ', '.join(QUESTIONS))
+                return
+
+            try:
+                if (forget_changed_datasets()):
+                    self.log_message('input files changed, reloading')
+                grouped_df = run_query(self.arguments, spec)
+                if (graph_type):
+                    content_type = 'application/pdf'
+                    buffer = io.BytesIO()
+                    draw_chart(grouped_df, question, spec, graph_type, buffer)
+                    body = buffer.getvalue()
+                else:
+                    content_type = 'text/csv'
+                    body = grouped_df.to_csv(index=False).encode()
+            except Exception as error:
+                self.send_error(500, str(error))
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    QueryHandler.arguments = arguments
+    server = http.server.HTTPServer((host or 'localhost', int(port)), QueryHandler)
+    print('Answering ' + ', '.join(QUESTIONS) + ' on http://' + (host or 'localhost') + ':' + port + '/', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# Arguments of create_bar and create_pie after the subject and statistic columns, for every question. {limit} in a label is replaced
+# by the number of rows the question was asked for (--TOP_N)
+CHARTS = {
+    'q1': ((6, 6, 'Airlines', 'Number of Routes with Destination Country as Canada', 'Top Airlines with Greatest Number of Routes to Canada'), (6, 6, 'Top Airlines with Greatest Number of Routes to Canada')),
+    'q2': ((6, 6, 'Least Popular Destination Countries', 'Number of Routes with this Country as Destination', 'Least Popular Destination Countries'), (6, 6, 'Least Popular Destination Countries')),
+    'q3': ((6, 6, 'Top Destination Airports', 'Number of Routes with Airport Destination', 'Top {limit} Destination Airports'), (7, 4, 'Top {limit} Destination Airports')),
+    'q4': ((6, 6, 'Top Destination Cities', 'Number of Routes with City Destination', 'Top {limit} Destination Cities'), (6, 6, 'Top {limit} Destination Cities')),
+    'q5': ((7, 6, 'Unique Route Codes', 'Difference in Destination and Origin Altitudes', 'Unique Top {limit} Canadian Routes with Greatest Difference in Altitude'), (6, 6, 'Unique Top {limit} Canadian Routes with Greatest Difference in Altitude')),
+}
+
+# Column of the routes dataset behind every route end a query can use
+ROUTE_COLUMNS = {
+    'airline_id': 'route_airline_id',
+    'origin_id': 'route_from_aiport_id',
+    'destination_id': 'route_to_airport_id',
+}
+# Values of QuerySpec.group_by and QuerySpec.metric, with the axis labels used in their charts
+GROUP_BY_LABELS = {
+    'airline': 'Airlines',
+    'country': 'Countries',
+    'airport': 'Airports',
+    'city': 'Cities',
+    'route': 'Routes',
+    'component': 'Route Networks (by largest hub)',
+}
+METRIC_LABELS = {
+    'routes': 'Number of Routes',
+    'altitude_difference': 'Difference in Destination and Origin Altitudes',
+    'degree': 'Number of Connected Airports',
+    'betweenness': 'Number of Shortest Paths Through the Airport',
+    'stops': 'Number of Stops',
+    'airports': 'Number of Airports',
+}
+# Metrics answered from the route network by run_graph_query, with the only group_by they can be used with
+GRAPH_METRICS = {
+    'degree': 'airport',
+    'betweenness': 'airport',
+    'stops': 'airport',
+    'airports': 'component',
+}
+
+QUESTIONS = {
+    'q1': QuerySpec(group_by='airline', country='Canada', limit=20),
+    'q2': QuerySpec(group_by='country', order='asc', limit=30),
+    'q3': QuerySpec(group_by='airport', limit=10),
+    'q4': QuerySpec(group_by='city', limit=15),
+    'q5': QuerySpec(group_by='route', metric='altitude_difference', direction='both', country='Canada', limit=10),
+}
 
 
 def main():
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks that load_route_counts of route_manager.py applies ADD_ROUTES and REMOVE_ROUTES deltas once each, and that removing an added
+delta gives back the counts it started from.
+Run with: python -m pytest test_route_counts.py
+"""
+
+# Importing all required modules
+import pandas as pd
+import route_manager
+
+
+def write_routes(file_name, routes):
+    """Parameters
+        ----------
+            file_name : str
+            routes : list
+
+            The routes file to write and its routes as (airline, origin, destination) ID tuples.
+
+        Returns
+        -------
+            str
+            file_name.
+    """
+    with open(file_name, 'w') as f:
+        f.write('routes:\n')
+        for airline, origin, destination in routes:
+            f.write("- route_airline_id: '" + str(airline) + "'\n  route_from_aiport_id: '" + str(origin)
+                    + "'\n  route_to_airport_id: '" + str(destination) + "'\n")
+    return file_name
+
+
+def apply_delta(counts_file, routes_file, **deltas):
+    """Parameters
+        ----------
+            counts_file : str
+            routes_file : str
+            deltas : str
+
+            The ROUTE_COUNTS and ROUTES files of one run and its ADD_ROUTES and REMOVE_ROUTES files, if any.
+
+        Returns
+        -------
+            pandas Dataframe
+            The route counts once the run applied its deltas, sorted so two runs can be compared.
+    """
+    route_manager.forget_datasets()
+    route_manager.load_route_counts(dict(deltas, ROUTE_COUNTS=counts_file, ROUTES=routes_file, CACHE='no'))
+    counts_df = pd.read_pickle(counts_file)['counts']
+    return counts_df.sort_values(list(counts_df.columns)).reset_index(drop=True)
+
+
+def test_remove_reverts_add(tmp_path):
+    routes_file = write_routes(str(tmp_path / 'routes.yaml'), [(1, 10, 20), (1, 10, 20), (2, 20, 30)])
+    delta_file = write_routes(str(tmp_path / 'delta.yaml'), [(1, 10, 20), (3, 30, 10)])
+    counts_file = str(tmp_path / 'counts.pickle')
+
+    base_df = apply_delta(counts_file, routes_file)
+    added_df = apply_delta(counts_file, routes_file, ADD_ROUTES=delta_file)
+    assert added_df['routes'].sum() == base_df['routes'].sum() + 2
+
+    # Adding the same file again is skipped, removing it afterwards is not
+    pd.testing.assert_frame_equal(apply_delta(counts_file, routes_file, ADD_ROUTES=delta_file), added_df)
+    pd.testing.assert_frame_equal(apply_delta(counts_file, routes_file, REMOVE_ROUTES=delta_file), base_df)
+    pd.testing.assert_frame_equal(apply_delta(counts_file, routes_file, REMOVE_ROUTES=delta_file), base_df)
+    pd.testing.assert_frame_equal(apply_delta(counts_file, routes_file, ADD_ROUTES=delta_file), added_df)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks the vectorized network algorithms of route_manager.py (graph_distances, graph_betweenness and graph_components) against plain
+Python breadth first search and Brandes' algorithm on small random networks.
+Run with: python -m pytest test_route_graph.py
+"""
+
+# Importing all required modules
+import collections
+import numpy as np
+import route_manager
+
+
+def random_network(seed, nodes, edges, both_ways):
+    """Parameters
+        ----------
+            seed : int
+            nodes : int
+            edges : int
+            both_ways : bool
+
+            The seed of the random generator, the number of nodes, the number of random edges drawn and whether every edge also goes back.
+
+        Returns
+        -------
+            tuple
+            The network in the compressed sparse row form of route_graph (sorted, without repetitions or edges from a node to itself) and
+            the same network as a dict of sets of neighbours.
+    """
+    rng = np.random.default_rng(seed)
+    origins = rng.integers(0, nodes, edges)
+    destinations = rng.integers(0, nodes, edges)
+    if (both_ways):
+        origins, destinations = np.concatenate([origins, destinations]), np.concatenate([destinations, origins])
+
+    neighbours = collections.defaultdict(set)
+    for origin, destination in zip(origins.tolist(), destinations.tolist()):
+        if (origin != destination):
+            neighbours[origin].add(destination)
+
+    indptr = np.zeros(nodes + 1, dtype=np.int64)
+    np.cumsum([len(neighbours[node]) for node in range(nodes)], out=indptr[1:])
+    indices = np.array([destination for node in range(nodes) for destination in sorted(neighbours[node])], dtype=np.int64)
+    return indptr, indices, neighbours
+
+
+def breadth_first_distances(neighbours, sources):
+    """Parameters
+        ----------
+            neighbours : dict
+            sources : list
+
+            The network as a dict of sets of neighbours and the nodes the search starts from.
+
+        Returns
+        -------
+            dict
+            The fewest edges needed to reach every reachable node from sources.
+    """
+    distances = {source: 0 for source in sources}
+    queue = collections.deque(sources)
+    while (queue):
+        node = queue.popleft()
+        for neighbour in neighbours[node]:
+            if (neighbour not in distances):
+                distances[neighbour] = distances[node] + 1
+                queue.append(neighbour)
+
+    return distances
+
+
+def brandes_betweenness(neighbours, nodes):
+    """Parameters
+        ----------
+            neighbours : dict
+            nodes : int
+
+            The network as a dict of sets of neighbours and its number of nodes.
+
+        Returns
+        -------
+            list
+            The betweenness of every node, computed one source at a time by Brandes' algorithm.
+    """
+    centrality = [0.0] * nodes
+    for source in range(nodes):
+        order = []
+        parents = collections.defaultdict(list)
+        paths = collections.defaultdict(float, {source: 1.0})
+        distances = {source: 0}
+        queue = collections.deque([source])
+        while (queue):
+            node = queue.popleft()
+            order.append(node)
+            for neighbour in neighbours[node]:
+                if (neighbour not in distances):
+                    distances[neighbour] = distances[node] + 1
+                    queue.append(neighbour)
+                if (distances[neighbour] == distances[node] + 1):
+                    paths[neighbour] += paths[node]
+                    parents[neighbour].append(node)
+
+        dependencies = collections.defaultdict(float)
+        for node in reversed(order):
+            for parent in parents[node]:
+                dependencies[parent] += paths[parent] / paths[node] * (1 + dependencies[node])
+            if (node != source):
+                centrality[node] += dependencies[node]
+
+    return centrality
+
+
+def test_graph_distances():
+    for seed in range(20):
+        indptr, indices, neighbours = random_network(seed, 40, 60, seed % 2 == 0)
+        sources = [seed % 40, (seed * 7) % 40]
+        expected = breadth_first_distances(neighbours, sources)
+        for max_depth in (0, 1, 2, 5, 40):
+            distances = route_manager.graph_distances(indptr, indices, np.array(sources), max_depth)
+            assert distances.tolist() == [expected[node] if expected.get(node, max_depth + 1) <= max_depth else -1 for node in range(40)]
+
+
+def test_graph_betweenness():
+    for seed in range(20):
+        indptr, indices, neighbours = random_network(seed, 30, 50, seed % 2 == 0)
+        np.testing.assert_allclose(route_manager.graph_betweenness(indptr, indices), brandes_betweenness(neighbours, 30), atol=1e-9)
+
+
+def test_graph_components():
+    for seed in range(20):
+        indptr, indices, neighbours = random_network(seed, 50, 30 + seed, True)
+        expected = list(range(50))
+        for node in range(50):
+            if (expected[node] == node):
+                for reached in breadth_first_distances(neighbours, [node]):
+                    expected[reached] = node
+        assert route_manager.graph_components(indptr, indices).tolist() == expected